@@ -11,6 +11,7 @@ import textwrap
 import re
 import string
 import sys
+import warnings
 
 world = world.copy()
 actionsystem = actionsystem.copy()
@@ -23,6 +24,7 @@ trybefore = make_rule_decorator(actionsystem.action_trybefore)
 before = make_rule_decorator(actionsystem.action_before)
 when = make_rule_decorator(actionsystem.action_when)
 report = make_rule_decorator(actionsystem.action_report)
+allincludes = make_rule_decorator(actionsystem.action_allincludes)
 
 def quickdef(world, obname, kind, props={}, **kwargs) :
     """Defines an object with less typing.  The props argument is a
@@ -42,7 +44,14 @@ def make_actorcontext_with_io(io_obj) :
     """Copies the game, and creates an ActorContext with the given io."""
     return ActorContext(None, io_obj, world.copy(), actionsystem.copy(), parser.copy(), stringeval.copy(), actoractivities.copy(), "player")
 
-def basic_begin_game(game_context) :
-    """Just start up the game using the supplied context."""
+def basic_begin_game(game_context, precompile_text=True) :
+    """Just start up the game using the supplied context.  If
+    precompile_text is set, then the text in the world is compiled
+    for the string evaluator first, and malformed text is reported
+    with warnings.warn (so it goes to stderr, and can be filtered or
+    turned into errors with the warnings module)."""
     game_context.world.set_game_defined()
+    if precompile_text :
+        for item, input, x in game_context.stringeval.precompile(game_context.world.text_values()) :
+            warnings.warn("malformed text in %r: %s" % (item, x), stacklevel=2)
     execute_context(game_context)
@@ -5,6 +5,7 @@
 # What's here:
 # Exceptions: DuplicateVariableException, NoMatchException
 # Patterns: AbstractPattern, VarPattern, BasicPattern
+# Compiled matching: compile_matcher, NO_MATCH
 
 ###
 ### Exceptions
@@ -23,6 +24,7 @@ class NoMatchException(Exception) :
 ###
 
 class AbstractPattern(object) :
+    __slots__ = ()
     def __init__(self) :
         raise NotImplementedError("AbstractPattern is abstract (no __init__)")
     def match(self, input, matches=None, data=None) :
@@ -76,8 +78,19 @@ class BasicPattern(AbstractPattern) :
     """A basic pattern which takes some number of
     subpatterns. Subpatterns may be other objects, but these are only
     tested for equality. This is essentially a tagged list
-    pattern. Subclasses need only make sure self.args is a list of
-    patterns."""
+    pattern. Subclasses need only make sure self.args is a tuple of
+    patterns.
+
+    The hash is computed from the class name and arguments, and it is
+    cached, so anything which changes self.args after the pattern has
+    been hashed must reset self._hash to None.  Equality checks
+    succeed by identity, and fail early when both cached hashes are
+    known and differ.
+
+    Instances are slotted, so subclasses which don't define __slots__
+    themselves only get an instance dictionary once some other
+    attribute is actually set."""
+    __slots__ = ("args", "_hash")
     def __init__(self, *args) :
         self.args = args
     def match(self, input, matches=None, data=None) :
@@ -107,8 +120,29 @@ class BasicPattern(AbstractPattern) :
         return world[self]
     def __repr__(self) :
         return "%s(%s)" % (self.__class__.__name__, ",".join(repr(a) for a in self.args))
+    def __hash__(self) :
+        try :
+            h = self._hash
+        except AttributeError : # subclass didn't call BasicPattern.__init__
+            h = None
+        if h is None :
+            try :
+                h = hash((type(self).__name__,) + tuple(self.args))
+            except TypeError : # unhashable arguments
+                h = hash(repr(self))
+            self._hash = h
+        return h
     def __eq__(self, other) :
-        return type(other) == type(self) and self.args == other.args
+        if self is other :
+            return True
+        if type(other) != type(self) :
+            return False
+        h = getattr(self, "_hash", None)
+        if h is not None :
+            h2 = getattr(other, "_hash", None)
+            if h2 is not None and h != h2 :
+                return False
+        return self.args == other.args
 
 class PatternRequires(AbstractPattern) :
     def __init__(self, pattern, support) :
@@ -165,6 +199,109 @@ class PEquals(AbstractPattern) :
     def __repr__(self) :
         return "PEquals(%r, %r)" % (self.a, self.b)
 
+###
+### Compiled matchers
+###
+
+class _NoMatch(object) :
+    """The type of NO_MATCH, which is what a compiled matcher returns
+    instead of raising NoMatchException."""
+    def __repr__(self) :
+        return "NO_MATCH"
+
+NO_MATCH = _NoMatch()
+
+class _CannotCompile(Exception) :
+    """Raised by _MatcherCompiler when a pattern has to be matched by
+    calling its match method."""
+    pass
+
+def compile_matcher(pattern) :
+    """Returns a function matcher(input, data=None) which returns what
+    pattern.match(input, data=data) would, except that it returns
+    NO_MATCH rather than raising NoMatchException.  Patterns built out
+    of BasicPattern, VarPattern, and PatternRequires are turned into
+    straight-line code which checks classes, arities, and constants
+    before binding any variables.  Anything else (for instance a
+    BasicPattern subclass with its own match method) is matched by
+    calling pattern.match."""
+    try :
+        return _MatcherCompiler().compile(pattern)
+    except _CannotCompile :
+        def _matcher(input, data=None) :
+            try :
+                return pattern.match(input, data=data)
+            except NoMatchException :
+                return NO_MATCH
+        return _matcher
+
+class _MatcherCompiler(object) :
+    """Generates the source of a matcher function.  The checks are
+    all done before the variables are bound since binding can't fail
+    (duplicate variables make the pattern uncompilable, so
+    DuplicateVariableException is still raised by match)."""
+    def __init__(self) :
+        self.lines = []
+        self.binds = []
+        self.env = {"NO_MATCH" : NO_MATCH}
+        self.num_names = 0
+    def compile(self, pattern) :
+        supports = []
+        while type(pattern) is PatternRequires :
+            supports.insert(0, pattern.support)
+            pattern = pattern.pattern
+        self.add_pattern(pattern, "input")
+        varnames = [v for v,e in self.binds]
+        if len(set(varnames)) != len(varnames) :
+            raise _CannotCompile()
+        source = ["def _matcher(input, data=None) :"]
+        source.extend("    "+line for line in self.lines)
+        matches = "{" + ", ".join("%r : %s" % b for b in self.binds) + "}"
+        if not supports :
+            source.append("    return "+matches)
+        else :
+            source.append("    matches = "+matches)
+            source.append("    try :")
+            for support in supports :
+                name = self.new_name("support", support)
+                source.append("        if not %s.expand_pattern(matches).test(data['world']) :" % name)
+                source.append("            return NO_MATCH")
+            source.append("    except KeyError :")
+            source.append("        return NO_MATCH")
+            source.append("    return matches")
+        exec "\n".join(source) in self.env
+        return self.env["_matcher"]
+    def new_name(self, prefix, value=None) :
+        self.num_names += 1
+        name = "%s%d" % (prefix, self.num_names)
+        if value is not None :
+            self.env[name] = value
+        return name
+    def add_pattern(self, pattern, expr) :
+        if type(pattern) is VarPattern :
+            self.binds.append((pattern.varName, expr))
+            if pattern.pattern is not None :
+                self.add_pattern(pattern.pattern, expr)
+        elif isinstance(pattern, BasicPattern) and type(pattern).match.__func__ is BasicPattern.match.__func__ :
+            cls = self.new_name("cls", type(pattern))
+            args = self.new_name("args")
+            self.lines.append("if %s.__class__ is not %s : return NO_MATCH" % (expr, cls))
+            self.lines.append("%s = %s.args" % (args, expr))
+            self.lines.append("if len(%s) != %d : return NO_MATCH" % (args, len(pattern.args)))
+            for i, arg in enumerate(pattern.args) :
+                argexpr = "%s[%d]" % (args, i)
+                if isinstance(arg, AbstractPattern) :
+                    if type(arg) is not VarPattern :
+                        name = self.new_name("arg")
+                        self.lines.append("%s = %s" % (name, argexpr))
+                        argexpr = name
+                    self.add_pattern(arg, argexpr)
+                else :
+                    const = self.new_name("const", arg)
+                    self.lines.append("if not (%s == %s) : return NO_MATCH" % (const, argexpr))
+        else :
+            raise _CannotCompile()
+
 ###
 ### Tests
 ###
@@ -216,5 +353,29 @@ class TestPatterns(unittest.TestCase) :
         self.assertRaises(KeyError, p.expand_pattern, {"y":3})
         self.assertEqual(p.expand_pattern({"x":3}), self.PActor(3))
 
+    def test_hash(self) :
+        a, b = self.PEnters("Kyle", "Vestibule"), self.PEnters("Kyle", "Vestibule")
+        self.assertEqual(hash(a), hash(b))
+        self.assertEqual(a, b)
+        self.assertNotEqual(hash(a), hash(self.PEnters("Kyle", "Hall")))
+        self.assertFalse(a == self.PEnters("Kyle", "Hall"))
+        self.assertEqual(hash(BasicPattern([1])), hash(BasicPattern([1])))
+        # hashed patterns with different hashes are unequal without comparing args
+        c = self.PEnters("Kyle", "Hall")
+        hash(c)
+        self.assertFalse(a == c)
+        self.assertTrue(a == self.PEnters("Kyle", "Vestibule"))
+
+    def test_compiled_matcher(self) :
+        pattern = self.PEnters(VarPattern("a", self.PActor(VarPattern("x"))), "Vestibule")
+        m = compile_matcher(pattern)
+        input = self.PEnters(self.PActor("Kyle"), "Vestibule")
+        self.assertEqual(m(input), pattern.match(input))
+        self.assertIs(m(self.PEnters(self.PActor("Kyle"), "Hall")), NO_MATCH)
+        self.assertIs(m(self.PEnters(self.PRoom("Kyle"), "Vestibule")), NO_MATCH)
+        self.assertIs(m(self.PRoom("Vestibule")), NO_MATCH)
+        m = compile_matcher(BasicPattern(VarPattern("x"), VarPattern("x")))
+        self.assertRaises(DuplicateVariableException, m, BasicPattern(1, 2))
+
 if __name__=="__main__" :
     unittest.main(verbosity=2)
@@ -6,7 +6,8 @@
 # Exceptions: NotHandled, AbortAction, ActionHandled, MultipleResults, FinishWith, RestartWith
 # Classes: ActionTable, PropertyTable, EventTable
 
-from patterns import NoMatchException, AbstractPattern, BasicPattern, VarPattern
+from patterns import NoMatchException, AbstractPattern, BasicPattern, VarPattern, PatternRequires, compile_matcher, NO_MATCH
+import heapq
 
 class AbortAction(Exception) :
     """Raised when a handler wants to stop the action from being
@@ -51,16 +52,41 @@ def handler_requires(b) :
 class PropertyTable(object) :
     """Represents a table of properties whose keys are patterns (for
     instance Description("myobj")).  Executes in reverse definition
-    order, and the first successful result is returned."""
+    order, and the first successful result is returned.
+
+    Besides the list of entries for each kind of property, entries
+    are indexed by their first argument when it is a ground value
+    (so that Description("myobj") does not have to be tested against
+    every other Description).  Entries whose first argument is a
+    pattern go into a fallback list which is always consulted.  Each
+    entry carries a compiled matcher for its pattern."""
     def __init__(self) :
         self.properties = dict() # dict for some optimization
+        self.index = dict() # file_under -> (dict of first arg -> entries, fallback entries)
+        self.num_entries = 0
     def set_property(self, item, value, call=False) :
         if not isinstance(item, AbstractPattern) :
             raise Exception("The only properties may be AbstractPatterns.")
         if not self.properties.has_key(item.file_under()) :
             self.properties[item.file_under()] = [(item, value, call)]
+            self.index[item.file_under()] = (dict(), [])
         else :
             self.properties[item.file_under()].insert(0, (item, value, call))
+        self.num_entries += 1
+        # entries are sorted by the negated definition number so that
+        # both lists are in reverse definition order.
+        self.__index_entry(self.index[item.file_under()],
+                           (-self.num_entries, item, value, call, compile_matcher(item)))
+    def __index_entry(self, index, entry) :
+        by_arg, fallback = index
+        key = entry[1]
+        if isinstance(key, BasicPattern) and key.args and not isinstance(key.args[0], AbstractPattern) :
+            try :
+                by_arg.setdefault(key.args[0], []).insert(0, entry)
+                return
+            except TypeError : # unhashable first argument
+                pass
+        fallback.insert(0, entry)
     def __setitem__(self, item, value) :
         self.set_property(item, value)
     def get_property(self, item, data) :
@@ -68,9 +94,20 @@ class PropertyTable(object) :
             raise Exception("The only properties may be BasicPatterns.")
         if not self.properties.has_key(item.file_under()) :
             raise KeyError(item)
-        for key,value,call in self.properties[item.file_under()] :
+        by_arg, fallback = self.index[item.file_under()]
+        try :
+            entries = by_arg.get(item.args[0]) if item.args else None
+        except TypeError : # unhashable first argument, so it can only match the fallbacks
+            entries = None
+        if entries is None :
+            entries = fallback
+        elif fallback :
+            entries = heapq.merge(entries, fallback)
+        for n,key,value,call,matcher in entries :
             try :
-                matches = key.match(item, data=data)
+                matches = matcher(item, data)
+                if matches is NO_MATCH :
+                    continue
                 if call :
                     for k,v in data.iteritems() :
                         matches[k] = v
@@ -89,6 +126,12 @@ class PropertyTable(object) :
             self.set_property(item, f, call=True)
             return f
         return __handler
+    def entries(self) :
+        """Iterates over the (item, value, call) entries of the
+        table."""
+        for props in self.properties.itervalues() :
+            for entry in props :
+                yield entry
     def dump(self) :
         for props in self.properties.itervalues() :
             for item, value, call in props :
@@ -105,6 +148,10 @@ class PropertyTable(object) :
         for t,table in self.properties.iteritems() :
             newdict[t] = list(table)
         newtable.properties = newdict
+        for t,(by_arg, fallback) in self.index.iteritems() :
+            newtable.index[t] = (dict((k, list(entries)) for k,entries in by_arg.iteritems()),
+                                 list(fallback))
+        newtable.num_entries = self.num_entries
         return newtable
     def make_documentation(self, escape, heading_level=1) :
         import inspect
@@ -143,7 +190,8 @@ class ActivityTable(object) :
     Accumulator is a function which takes the list of results to make
     a return value.  By default it's just the identity function.
     Unlike the other tables in the rulesystem, the functions are not
-    selected by a pattern."""
+    selected by a pattern, though the caller of notify may pass a set
+    of functions to skip."""
     def __init__(self, accumulator=None, reverse=False, doc=None) :
         self.actions = []
         self.wants_table = []
@@ -153,11 +201,11 @@ class ActivityTable(object) :
         self.disabled = []
         self.current_disabled = None
         self.last_current_disabled = []
-    def notify(self, args, data, disable=None) :
+    def notify(self, args, data, disable=None, skip=None) :
         self.__push_current_disabled(disable or [])
         acc = []
         for f, wt in zip(self.actions, self.wants_table) :
-            if f in self.current_disabled :
+            if f in self.current_disabled or (skip and f in skip) :
                 continue
             try :
                 if wt :
@@ -291,6 +339,42 @@ class ActivityTable(object) :
         else :
             print "<p><i>No entries</i></p>"
 
+def _constant_args(pattern, file_under) :
+    """Gets (n, consts) if the pattern only matches events of class
+    file_under with n arguments, where consts is a dictionary from
+    positions to the constants the arguments there must equal, and if
+    failing to match these is all it takes for the pattern not to
+    match (its other arguments are distinct plain variables).
+    Otherwise gets None."""
+    while type(pattern) is PatternRequires :
+        pattern = pattern.pattern
+    if (type(pattern) is not file_under or not isinstance(pattern, BasicPattern)
+        or type(pattern).match.__func__ is not BasicPattern.match.__func__) :
+        return None
+    consts = {}
+    varnames = set()
+    for i, arg in enumerate(pattern.args) :
+        if not isinstance(arg, AbstractPattern) :
+            consts[i] = arg
+        elif type(arg) is VarPattern and arg.pattern is None and arg.varName not in varnames :
+            varnames.add(arg.varName)
+        else :
+            return None
+    return (len(pattern.args), consts)
+
+def _filter_handlers(entries, args) :
+    """Takes (entry, constant args) pairs from RuleTable.handlers_for
+    and gets the entries which might match an event with the given
+    arguments."""
+    handlers = []
+    for entry, c in entries :
+        if c is not None :
+            n, consts = c
+            if n != len(args) or not all(const == args[i] for i, const in consts.iteritems()) :
+                continue
+        handlers.append(entry)
+    return handlers
+
 class RuleTable(object) :
     """The rule table is a bunch of patterns and function pairs.
     OUT-OF-DATE DOCUMENTATION. The variables are applied to each
@@ -303,7 +387,9 @@ class RuleTable(object) :
     executed first.
 
     This is basically an ActivityTable which also first pattern
-    matches."""
+    matches.  The patterns are compiled into matchers when they are
+    added, and the handlers which might match an event are looked up
+    with handlers_for."""
     def __init__(self, accumulator=None, reverse=True, doc=None) :
         self.actions = {"default" : []} # default is for the tables not defined yet.
         self.accumulator = accumulator or identity
@@ -312,6 +398,7 @@ class RuleTable(object) :
         self.disabled = []
         self.current_disabled = None
         self.last_current_disabled = []
+        self.handler_cache = {}
     def add_handler(self, pattern, f, insert_first=None, insert_last=None, insert_before=None, insert_after=None, wants_event=False, wants_table=False) :
         """Adds (pattern, f) to the table.  At most one of the following may be set:
         * insert_first: puts the handler in a position so it executes first
@@ -334,31 +421,64 @@ class RuleTable(object) :
             destinations = [self.actions[file_under]]
         else :
             destinations = self.actions.values()
+        entry = (pattern, f, wants_event, wants_table, compile_matcher(pattern))
+        self.handler_cache = {}
         for actions in destinations :
             if insert_first :
-                actions.insert(0, (pattern, f, wants_event, wants_table))
+                actions.insert(0, entry)
             elif insert_last :
-                actions.append((pattern, f, wants_event, wants_table))
+                actions.append(entry)
             elif insert_before :
                 for i in xrange(0, len(actions)) :
                     if actions[i][1] is insert_before : break
                 else : raise Exception("insert_before failed, since %r not in table." % insert_before)
-                actions.insert(i, (pattern, f, wants_event, wants_table))
+                actions.insert(i, entry)
             elif insert_after :
                 for i in xrange(0, len(actions)) :
                     if actions[i][1] is insert_after : break
                 else : raise Exception("insert_after failed, since %r not in table." % insert_after)
-                actions.insert(i+1, (pattern, f, wants_event, wants_table))
-    def notify(self, event, data, pattern_data=None, disable=None) :
+                actions.insert(i+1, entry)
+    def handlers_for(self, event) :
+        """Gets the entries which might handle the event, in the order
+        they are run.  These are the entries filed under the event's
+        class, less those whose patterns have a constant argument
+        which the event doesn't.  The lists are cached by the event's
+        class and by those of its arguments which some pattern
+        compares to a constant, and the cache is cleared whenever a
+        handler is added."""
+        file_under = event.file_under()
+        try :
+            entries, positions, lists = self.handler_cache[file_under]
+        except KeyError :
+            entries = [(e, _constant_args(e[0], file_under))
+                       for e in self.actions.get(file_under, self.actions["default"])]
+            positions = sorted(set(i for e, c in entries if c for i in c[1]))
+            entries, positions, lists = self.handler_cache[file_under] = (entries, positions, {})
+        args = event.args
+        key = (len(args),) + tuple(args[i] for i in positions if i < len(args))
+        try :
+            return lists[key]
+        except KeyError :
+            handlers = lists[key] = _filter_handlers(entries, args)
+            return handlers
+        except TypeError : # unhashable arguments
+            return _filter_handlers(entries, args)
+    def notify(self, event, data, pattern_data=None, disable=None, handlers=None) :
+        """Runs the handlers for the event.  If handlers is given, it
+        should be what handlers_for returns for the event."""
+        if handlers is None :
+            handlers = self.handlers_for(event)
         self.__push_current_disabled(disable or [])
         accum = []
         if not pattern_data :
             pattern_data = data
-        for (pattern, f, wants_event, wants_table) in self.actions.get(event.file_under(), self.actions["default"]) :
+        for (pattern, f, wants_event, wants_table, matcher) in handlers :
             if f in self.current_disabled :
                 continue
             try :
-                matches = pattern.match(event, data=pattern_data)
+                matches = matcher(event, pattern_data)
+                if matches is NO_MATCH :
+                    continue
                 for k,v in data.iteritems() :
                     matches[k] = v
                 if wants_event :
@@ -401,7 +521,7 @@ class RuleTable(object) :
         if self.current_disabled is not None :
             raise Exception("Should be using temp_disable.")
         if f :
-            if any(f==f0 for (p,f0,we,wt) in list_append(self.actions.values())) :
+            if any(f==f0 for (p,f0,we,wt,m) in list_append(self.actions.values())) :
                 self.disabled.append(f)
             else :
                 raise Exception("The given f=%r is not in the table." % f)
@@ -411,7 +531,7 @@ class RuleTable(object) :
         """This disables a function temporarily during the execution
         of the table."""
         if f :
-            if any(f==f0 for (p,f0,we,wt) in list_append(self.actions.values())) :
+            if any(f==f0 for (p,f0,we,wt,m) in list_append(self.actions.values())) :
                 self.current_disabled.append(f)
             else :
                 raise Exception("The given f=%r is not in the table." % f)
@@ -456,7 +576,7 @@ class RuleTable(object) :
                 print "<h"+hls+">"+escape(file_under.__name__)+"</h"+hls+">"
                 print "<p>"+(escape(file_under.__doc__) or "<i>No documentation for pattern.</i>")+"</p>"
                 print "<ol>"
-                for key,handler,we,wt in actions :
+                for key,handler,we,wt,m in actions :
                     print "<li><p>"
                     if handler in self.disabled :
                         print "<b><i>DISABLED</i></b>"
@@ -577,5 +697,44 @@ class TestEvents(unittest.TestCase) :
         except AbortAction :
             self.assertEqual(test, ["action2:vestibule"])
 
+class TestPropertyTable(unittest.TestCase) :
+    class PDesc(BasicPattern) :
+        def __init__(self, obj) :
+            self.args = [obj]
+
+    def test_reverse_definition_order(self) :
+        table = PropertyTable()
+        table[self.PDesc(VarPattern("x"))] = "default"
+        table[self.PDesc("ball")] = "ball"
+        table[self.PDesc("box")] = "box"
+        self.assertEqual(table.get_property(self.PDesc("ball"), {}), "ball")
+        self.assertEqual(table.get_property(self.PDesc("lamp"), {}), "default")
+        # a later variable entry shadows the earlier indexed ones
+        table[self.PDesc(VarPattern("x"))] = "override"
+        self.assertEqual(table.get_property(self.PDesc("ball"), {}), "override")
+        self.assertEqual(table.copy().get_property(self.PDesc("box"), {}), "override")
+
+class TestRuleTable(unittest.TestCase) :
+    class PTakes(BasicPattern) :
+        def __init__(self, actor, obj) :
+            self.args = [actor, obj]
+
+    def test_handlers_for(self) :
+        table = RuleTable()
+        test = []
+        def any_take(x, y) : test.append("any:"+x)
+        def take_ball(x) : test.append("ball:"+x)
+        table.add_handler(self.PTakes(VarPattern("x"), VarPattern("y")), any_take)
+        table.add_handler(self.PTakes(VarPattern("x"), "ball"), take_ball)
+        self.assertEqual([e[1] for e in table.handlers_for(self.PTakes("kyle", "ball"))],
+                         [take_ball, any_take])
+        self.assertEqual([e[1] for e in table.handlers_for(self.PTakes("kyle", "box"))],
+                         [any_take])
+        # the cache is cleared when a handler is added
+        def take_box(x) : test.append("box:"+x)
+        table.add_handler(self.PTakes(VarPattern("x"), "box"), take_box)
+        table.notify(self.PTakes("kyle", "box"), {})
+        self.assertEqual(test, ["box:kyle", "any:kyle"])
+
 if __name__=="__main__" :
     unittest.main(verbosity=2)
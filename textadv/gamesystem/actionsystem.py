@@ -15,6 +15,7 @@ class BasicAction(BasicPattern) :
     """All patterns which represent actions should subclass this
     object.  It importantly implements gerund_form, which should print
     something informative like "doing suchandsuch with whatever"."""
+    __slots__ = ()
     verb = "NEED VERB"
     gerund = "NEEDING GERUND"
     num_turns = 1
@@ -28,8 +29,8 @@ class BasicAction(BasicPattern) :
     def update_actor(self, newactor) :
         """Sometimes the actor is not set properly (for instance, with
         AskingTo).  We need to be able to reset it."""
-        self.args = list(self.args)
-        self.args[0] = newactor
+        self.args = (newactor,) + tuple(self.args[1:])
+        self._hash = None
     def get_actor(self) :
         """An accessor method for the actor of the action. Assumed to
         be first element."""
@@ -85,6 +86,31 @@ class BasicAction(BasicPattern) :
             return (self.verb[0] + " " + dobj + " " + self.verb[1] + " " + iobj)
         else :
             raise Exception("Default gerund form only works with 1-3 args")
+class MultipleObjects(object) :
+    """Stands in for the object of an action when the player names
+    several things at once, as in "take the lamp and the ball" or
+    "drop everything but the lamp".  The objects are in the order they
+    were given.  If is_all is set, then the objects came from "all"
+    and are only the candidates (see ActionSystem.expand_action)."""
+    __slots__ = ("objects", "is_all")
+    def __init__(self, objects, is_all=False) :
+        self.objects = tuple(objects)
+        self.is_all = is_all
+    def __eq__(self, other) :
+        return (type(other) is MultipleObjects
+                and self.objects == other.objects and self.is_all == other.is_all)
+    def __ne__(self, other) :
+        return not self.__eq__(other)
+    def __hash__(self) :
+        return hash((self.objects, self.is_all))
+    def __repr__(self) :
+        return "MultipleObjects(%r, is_all=%r)" % (list(self.objects), self.is_all)
+
+def is_multiple_action(action) :
+    """Checks whether one of the arguments of the action is
+    MultipleObjects."""
+    return any(type(a) is MultipleObjects for a in action.args)
+
 ###
 ### Handling actions
 ###
@@ -101,15 +127,36 @@ class ActionSystem(object) :
         self.action_when = RuleTable(doc="""Carries out the action.  Must not fail.""")
         self.action_report = RuleTable(doc="""Explains what happened with this
         action.  Should not change world state.""")
+        self.action_allincludes = RuleTable(doc="""Decides whether "all" includes
+        the object of an action (for instance, "take all" should leave out
+        what is fixed in place).  A handler returns False to leave the
+        object out.  Should not change world state.""")
         self.verify = make_rule_decorator(self.action_verify)
         self.trybefore = make_rule_decorator(self.action_trybefore)
         self.before = make_rule_decorator(self.action_before)
         self.when = make_rule_decorator(self.action_when)
         self.report = make_rule_decorator(self.action_report)
+        self.allincludes = make_rule_decorator(self.action_allincludes)
     def verify_action(self, action, ctxt) :
         """Returns either the best reason for doing the action, or, if
-        there is a reason not to do it, the worst."""
-        reasons = self.action_verify.notify(action, {"ctxt" : ctxt}, {"world" : ctxt.world})
+        there is a reason not to do it, the worst.  Verification
+        happens in a memo scope of the world since it should not
+        change the world.  An action on MultipleObjects is as
+        reasonable as the worst of the actions it expands to."""
+        if is_multiple_action(action) :
+            expanded = self.expand_action(action, ctxt)
+            if not expanded :
+                return IllogicalOperation("There is nothing to do that to.")
+            reasons = self.verify_actions([a for o, a in expanded], ctxt)
+            return min(reasons, key=lambda x : x.score)
+        handlers = self.action_verify.handlers_for(action)
+        if not handlers :
+            return LogicalOperation()
+        ctxt.world.begin_memo()
+        try :
+            reasons = self.action_verify.notify(action, {"ctxt" : ctxt}, {"world" : ctxt.world}, handlers=handlers)
+        finally :
+            ctxt.world.end_memo()
         reasons = [r for r in reasons if r is not None]
         reasons.sort(key=lambda x : x.score)
         if len(reasons) == 0 :
@@ -119,6 +166,79 @@ class ActionSystem(object) :
                 return reasons[0]
             else :
                 return reasons[-1]
+    def verify_actions(self, actions, ctxt) :
+        """Verifies a list of actions, returning the list of their
+        verifications (see verify_action).  All of them are verified
+        in one memo scope of the world so that they share what they
+        read from it, and actions which are equal are only verified
+        once."""
+        verified = {}
+        out = []
+        ctxt.world.begin_memo()
+        try :
+            for action in actions :
+                v = verified.get(action)
+                if v is None :
+                    v = verified[action] = self.verify_action(action, ctxt)
+                out.append(v)
+        finally :
+            ctxt.world.end_memo()
+        return out
+    def expand_action(self, action, ctxt) :
+        """Expands an action on MultipleObjects into a list of (object,
+        action) pairs, one for each of the objects.  For "all", only
+        the objects for which the action is reasonable and which
+        action_allincludes doesn't leave out are kept."""
+        i = [n for n, a in enumerate(action.args) if type(a) is MultipleObjects][0]
+        multiple = action.args[i]
+        expanded = []
+        for o in multiple.objects :
+            args = list(action.args)
+            args[i] = o
+            expanded.append((o, type(action)(*args)))
+        if multiple.is_all :
+            reasons = self.verify_actions([a for o, a in expanded], ctxt)
+            ctxt.world.begin_memo()
+            try :
+                expanded = [(o, a) for (o, a), r in zip(expanded, reasons)
+                            if self.all_includes(a, r, ctxt)]
+            finally :
+                ctxt.world.end_memo()
+        return expanded
+    def all_includes(self, action, reason, ctxt) :
+        """Checks whether "all" includes the object of the action,
+        given its verification reason (see expand_action)."""
+        if not reason.is_acceptible() :
+            return False
+        ctxt.world.begin_memo()
+        try :
+            return False not in self.action_allincludes.notify(action, {"ctxt" : ctxt}, {"world" : ctxt.world})
+        finally :
+            ctxt.world.end_memo()
+    def run_multiple_action(self, action, ctxt) :
+        """Runs an action on MultipleObjects by running each of the
+        actions it expands to, one line per object.  If one of them
+        is aborted, the rest are still run.  For "all", each object
+        is checked again just before its action since the earlier
+        actions may have changed whether it should be included (for
+        instance, by taking the container it is in)."""
+        expanded = self.expand_action(action, ctxt)
+        if not expanded :
+            ctxt.write("There is nothing to do that to.")
+            raise AbortAction()
+        is_all = any(type(a) is MultipleObjects and a.is_all for a in action.args)
+        first = True
+        for o, a in expanded :
+            if is_all and not first and not self.all_includes(a, self.verify_action(a, ctxt), ctxt) :
+                continue
+            label = str_with_objs("[The $x]:", x=o)
+            ctxt.write(label if first else "[break]"+label)
+            first = False
+            try :
+                self.run_action(a, ctxt)
+            except AbortAction as ab :
+                if len(ab.args) > 0 :
+                    ctxt.write(*ab.args, **ab.kwargs)
     def run_action(self, action, ctxt, is_implied=False, write_action=False, silently=False) :
         """Runs an action by the following steps:
         * Verify - if the action is not reasonable, then the action fails
@@ -134,7 +254,17 @@ class ActionSystem(object) :
         write_action is a boolean or a string such as "(first %s)".
         If considered to be true, then describes action.
 
-        silently, if true, prevents reporting the action."""
+        silently, if true, prevents reporting the action.
+
+        An action on MultipleObjects is run with run_multiple_action
+        instead, which labels each line with its object.
+
+        The handlers for each step are looked up once with
+        handlers_for (which caches them by the action's class and
+        constant arguments), and steps without any are skipped."""
+        if is_multiple_action(action) :
+            self.run_multiple_action(action, ctxt)
+            return
         if (write_action or is_implied) :
             if write_action is True : write_action = "(%s)"
             ctxt.write(write_action % action.gerund_form(ctxt))
@@ -143,18 +273,28 @@ class ActionSystem(object) :
         if not reasonable.is_acceptible() :
             ctxt.write(reasonable.reason)
             raise AbortAction()
-        self.action_trybefore.notify(action, {"ctxt" : ctxt}, {"world" : ctxt.world})
-        try :
-            self.action_before.notify(action, {"ctxt" : ctxt}, {"world" : ctxt.world})
-        except DoInstead as ix :
-            msg = False if ix.suppress_message or silently else "(%s instead)"
-            self.run_action(ix.instead, ctxt, write_action=msg)
-            return
-        did_something = self.action_when.notify(action, {"ctxt" : ctxt}, {"world" : ctxt.world})
+        data = {"ctxt" : ctxt}
+        pattern_data = {"world" : ctxt.world}
+        handlers = self.action_trybefore.handlers_for(action)
+        if handlers :
+            self.action_trybefore.notify(action, data, pattern_data, handlers=handlers)
+        handlers = self.action_before.handlers_for(action)
+        if handlers :
+            try :
+                self.action_before.notify(action, data, pattern_data, handlers=handlers)
+            except DoInstead as ix :
+                msg = False if ix.suppress_message or silently else "(%s instead)"
+                self.run_action(ix.instead, ctxt, write_action=msg)
+                return
+        handlers = self.action_when.handlers_for(action)
+        if handlers :
+            did_something = self.action_when.notify(action, data, pattern_data, handlers=handlers)
         #if not did_something :
         #    raise AbortAction("There was nothing to do.") # this doesn't seem to be the right thing to do.
         if not silently :
-            self.action_report.notify(action, {"ctxt" : ctxt}, {"world" : ctxt.world})
+            handlers = self.action_report.handlers_for(action)
+            if handlers :
+                self.action_report.notify(action, data, pattern_data, handlers=handlers)
     def do_first(self, action, ctxt, silently=False) :
         """Runs an action with a "(first /doing something/)" message.
         If silently is True, then this message is not printed."""
@@ -168,11 +308,13 @@ class ActionSystem(object) :
         newat.action_before = self.action_before.copy()
         newat.action_when = self.action_when.copy()
         newat.action_report = self.action_report.copy()
+        newat.action_allincludes = self.action_allincludes.copy()
         newat.verify = make_rule_decorator(newat.action_verify)
         newat.trybefore = make_rule_decorator(newat.action_trybefore)
         newat.before = make_rule_decorator(newat.action_before)
         newat.when = make_rule_decorator(newat.action_when)
         newat.report = make_rule_decorator(newat.action_report)
+        newat.allincludes = make_rule_decorator(newat.action_allincludes)
         return newat
     def make_documentation(self, escape, heading_level=1) :
         hls = str(heading_level)
@@ -187,6 +329,7 @@ class ActionSystem(object) :
         _make_action_docs(heading_level, self.action_before, "action_before")
         _make_action_docs(heading_level, self.action_when, "action_when")
         _make_action_docs(heading_level, self.action_report, "action_report")
+        _make_action_docs(heading_level, self.action_allincludes, "action_allincludes")
 
 
 ##
@@ -251,3 +394,34 @@ def verify_instead(action, ctxt) :
     """Used when it's necessary to verify another action because it's
     known that a before handler is going to throw a DoInstead."""
     raise ActionHandled(verify_action(action, ctxt))
+
+###
+### Tests
+###
+import unittest
+
+class TestMultipleActions(unittest.TestCase) :
+    def test_take_all_with_container(self) :
+        from textadv import basicsetup
+        from textadv.gamesystem.gamecontexts import ActorContext
+        from textadv.gamesystem.output import OutputBuilder, TextRenderer
+        class IO(object) :
+            def __init__(self) :
+                self.output = OutputBuilder(TextRenderer())
+            def write(self, *data) :
+                self.output.write(*data)
+        ctxt = ActorContext(None, IO(), basicsetup.world.copy(), basicsetup.actionsystem.copy(),
+                            basicsetup.parser.copy(), basicsetup.stringeval.copy(),
+                            basicsetup.actoractivities.copy(), "player")
+        basicsetup.quickdef(ctxt.world, "hall", "room")
+        ctxt.world.activity.put_in("player", "hall")
+        basicsetup.quickdef(ctxt.world, "box", "container", put_in="hall")
+        basicsetup.quickdef(ctxt.world, "ball", "thing", put_in="box")
+        basicsetup.quickdef(ctxt.world, "lamp", "thing", put_in="hall")
+        action, disambiguated = ctxt.parser.handle_all("take all", ctxt, ctxt.actionsystem.verify_action)
+        ctxt.actionsystem.run_action(action, ctxt)
+        # the ball came along with the box, so it is left out
+        self.assertEqual(ctxt.io.output.finish(), "The box: Taken.\nThe lamp: Taken.")
+
+if __name__=="__main__" :
+    unittest.main(verbosity=2)
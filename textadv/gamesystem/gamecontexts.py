@@ -13,6 +13,7 @@ from textadv.core.rulesystem import AbortAction, ActionHandled, ActivityHelperOb
 from textadv.core.rulesystem import ActivityTable, RuleTable
 from textadv.gamesystem.utilities import *
 from textadv.gamesystem import parser
+from textadv.gamesystem.actionsystem import MultipleObjects
 #from textadv.gamesystem.basicpatterns import X,Y,Z
 
 def execute_context(context, **kwargs) :
@@ -109,6 +110,7 @@ class ActorContext(GameContext) :
         self.parser = parser
         self.stringeval = stringeval
         self.actoractivities = actoractivities
+        self.pending_commands = iter([]) # the rest of a line waiting on disambiguation
     def write(self, *stuff, **kwargs) :
         """Writes a line by evaluating the string using the utilities
         module.  If there is an actor, then the text is wrapped so
@@ -118,52 +120,99 @@ class ActorContext(GameContext) :
         newstuff = [self.stringeval.eval_str(s, self) for s in stuff]
         self.io.write(*newstuff)
     def run(self, input=None, action=None) :
+        """Runs the commands in a line of input (or the given action).
+        The commands in a line are separated by periods or "then",
+        and they are run one after the other until one of them fails
+        to parse or is aborted.  If one of them needs to be
+        disambiguated, the rest of the line is run after the
+        disambiguated action is given back as the action argument."""
         if not self.world.get_property("Global", "game_started") :
             self.activity.start_game()
             self.io.set_status_var("headline", self.stringeval.eval_str(self.activity.make_current_location_headline(self.actor), self))
         try :
-            if input is None and action is None:
-                input = self.io.get_input()
-                if input == "dump" :
-                    self.world.dump()
-                    return (self, {})
-            try :
-                if action is None :
-                    action, disambiguated = self.parser.handle_all(input, self, self.actionsystem.verify_action)
-                else :
-                    disambiguated = True
-                try :
-                    if disambiguated :
-                        self.actionsystem.run_action(action, self, write_action=True)
-                    else :
-                        self.actionsystem.run_action(action, self)
-                except AbortAction as ab :
-                    if len(ab.args) > 0 : # the AbortAction may contain a message
-                        self.write(*ab.args, **ab.kwargs)
-                if self.world.get_property("Global", "end_game_message") :
-                    self.activity.end_game_actions()
-                    if self.world.get_property("Global", "end_game_message") :
-                        self.io.set_status_var("headline", "*** Game over ***")
-                        self.io.flush()
-                        return (None, {})
-                for i in xrange(0, action.num_turns) :
-                    self.activity.step_turn()
-                self.io.set_status_var("headline", self.stringeval.eval_str(self.activity.make_current_location_headline(self.actor), self))
-            except parser.NoSuchWord as ex :
-                esc = escape_str(ex.word)
-                self.write("I don't know what you mean by '%s'." % esc)
-            except parser.NoUnderstand :
-                self.write("Huh?")
-            except parser.NoInput :
-                pass
-            except parser.Ambiguous as ex :
-                return (DisambiguationContext(self, ex), dict())
+            pending, self.pending_commands = self.pending_commands, iter([])
+            if action is not None :
+                result = self.run_command(action=action)
+                if result is not None :
+                    return result
+                commands = pending
+            else :
+                if input is None :
+                    input = self.io.get_input()
+                    if input == "dump" :
+                        self.world.dump()
+                        return (self, {})
+                commands = self.parser.split_commands(input, self.parse_command)
+            for i, (command, parsed) in enumerate(commands) :
+                if i > 0 or action is not None :
+                    self.write("[newline]")
+                result = self.run_command(input=command, parsed=parsed)
+                if result is not None :
+                    if isinstance(result[0], DisambiguationContext) :
+                        self.pending_commands = commands
+                    return result
             return (self, dict())
         except Exception :
             import traceback
             traceback.print_exc()
             self.io.write("<pre>"+traceback.format_exc()+"</pre>")
             return (self, dict())
+    def parse_command(self, input) :
+        """Parses and disambiguates a single command (see
+        Parser.handle_all)."""
+        return self.parser.handle_all(input, self, self.actionsystem.verify_action)
+    def run_command(self, input=None, action=None, parsed=None) :
+        """Parses and runs a single command.  If parsed is given, it
+        gives back the result of parsing the input (see
+        Parser.split_commands).  Returns None if the command ran, and
+        otherwise the (context, kwargs) which the run method should
+        return, since the rest of the line should not be run."""
+        self.stringeval.reset_counters()
+        try :
+            if action is None :
+                if parsed is None :
+                    action, disambiguated = self.parse_command(input)
+                else :
+                    action, disambiguated = parsed()
+            else :
+                disambiguated = True
+            aborted = False
+            try :
+                if disambiguated :
+                    self.actionsystem.run_action(action, self, write_action=True)
+                else :
+                    self.actionsystem.run_action(action, self)
+            except AbortAction as ab :
+                aborted = True
+                if len(ab.args) > 0 : # the AbortAction may contain a message
+                    self.write(*ab.args, **ab.kwargs)
+            if self.world.get_property("Global", "end_game_message") :
+                self.activity.end_game_actions()
+                if self.world.get_property("Global", "end_game_message") :
+                    self.io.set_status_var("headline", "*** Game over ***")
+                    self.io.flush()
+                    return (None, {})
+            for i in xrange(0, action.num_turns) :
+                self.activity.step_turn()
+            self.io.set_status_var("headline", self.stringeval.eval_str(self.activity.make_current_location_headline(self.actor), self))
+            if aborted :
+                return (self, dict())
+        except parser.NoSuchWord as ex :
+            esc = escape_str(ex.word)
+            if ex.suggestions :
+                sugg = serial_comma(["'%s'" % escape_str(w) for w in ex.suggestions], conj="or")
+                self.write("I don't know what you mean by '%s'.  Did you mean %s?" % (esc, sugg))
+            else :
+                self.write("I don't know what you mean by '%s'." % esc)
+            return (self, dict())
+        except parser.NoUnderstand :
+            self.write("Huh?")
+            return (self, dict())
+        except parser.NoInput :
+            return (self, dict())
+        except parser.Ambiguous as ex :
+            return (DisambiguationContext(self, ex), dict())
+        return None
     def call_activity(self, name, *args, **kwargs) :
         kwargs["ctxt"] = self
         return self.actoractivities.call(name, *args, **kwargs)
@@ -177,6 +226,14 @@ class ActorContext(GameContext) :
         """Gets the event table of the given name."""
         return actorrules.rule_table(name)
 
+def first_difference(multiples) :
+    """Gets the first position at which the objects of the
+    MultipleObjects differ, or None if there is no such position."""
+    for n in xrange(min(len(m.objects) for m in multiples)) :
+        if any(m.objects[n] != multiples[0].objects[n] for m in multiples) :
+            return n
+    return None
+
 class DisambiguationContext(GameContext) :
     def __init__(self, parent, amb) :
         self.parent = parent
@@ -186,20 +243,42 @@ class DisambiguationContext(GameContext) :
         if len(self.amb.options) > 1 :
             self.parent.write("I'm a bit confused by what you meant in a couple of places.")
         for var, opts in self.amb.options.iteritems() :
-            query = serial_comma([self.parent.world.get_property("DefiniteName", o)
-                                  for o in opts], conj="or")
-            self.parent.write("Did you mean "+query+"?")
-            input = self.parent.io.get_input(">>>")
-            self.parent.parser.init_current_objects(self.parent, {self.amb.subparsers[var] : opts})
-            res = self.parent.parser.run_parser(self.amb.subparsers[var],
-                                                self.parent.parser.transform_text_to_words(input),
-                                                self.parent)
-            if len(res) == 0 : # let the parent parse it instead.
-                return (self.parent, {"input" : input})
-            elif len(res) == 1 :
-                repl[var] = res[0][0].value
-            else :
-                self.parent.write("That didn't help me out at all.")
-                return (self.parent, dict())
+            while True :
+                if isinstance(opts[0], MultipleObjects) :
+                    # ask about the first of the listed things which
+                    # isn't settled yet
+                    n = first_difference(opts)
+                    if n is None :
+                        self.parent.write("That didn't help me out at all.")
+                        return (self.parent, dict())
+                    choices = []
+                    for m in opts :
+                        if m.objects[n] not in choices :
+                            choices.append(m.objects[n])
+                    subparser = "something"
+                else :
+                    choices = opts
+                    subparser = self.amb.subparsers[var]
+                query = serial_comma([self.parent.world.get_property("DefiniteName", o)
+                                      for o in choices], conj="or")
+                self.parent.write("Did you mean "+query+"?")
+                input = self.parent.io.get_input(">>>")
+                self.parent.parser.init_current_objects(self.parent, {subparser : choices})
+                res = self.parent.parser.run_parser(subparser,
+                                                    self.parent.parser.transform_text_to_words(input),
+                                                    self.parent)
+                if len(res) == 0 : # let the parent parse it instead.
+                    return (self.parent, {"input" : input})
+                elif len(res) > 1 :
+                    self.parent.write("That didn't help me out at all.")
+                    return (self.parent, dict())
+                value = res[0][0].value
+                if isinstance(opts[0], MultipleObjects) :
+                    opts = [m for m in opts if len(m.objects) > n and m.objects[n] == value]
+                    if len(opts) > 1 :
+                        continue
+                    value = opts[0]
+                repl[var] = value
+                break
         return (self.parent, {"action" : self.amb.pattern.expand_pattern(repl)})
 
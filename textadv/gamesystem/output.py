@@ -0,0 +1,124 @@
+# output.py
+#
+# Turns what the game writes into output for an IO object.
+#
+# provides: OutputBuilder, HTMLRenderer, TextRenderer, JSONEventRenderer
+
+import re
+import json
+import textwrap
+
+FORMATTING_CODES = re.compile(r"\[(newline|break|indent)\]")
+
+class OutputBuilder(object) :
+    """Collects the chunks of text written by the game.  As in the
+    IO objects, chunks are separated by a space.  Each chunk is split
+    into text and formatting codes ([newline], [break], and [indent])
+    as it arrives, and these are handed to the renderer, which builds
+    the output for one flush.  A renderer may be anything which
+    implements the following three methods:
+
+    text(s) -- handles a piece of text;
+    code(name) -- handles the formatting code name (one of "newline",
+    "break", or "indent");
+    finish() -- returns the output and starts over;
+    combine(outputs) -- joins the outputs of several finishes into
+    one, for IO objects which send them together."""
+    def __init__(self, renderer) :
+        self.renderer = renderer
+        self.started = False
+    def write(self, *data) :
+        renderer = self.renderer
+        for chunk in data :
+            if self.started :
+                renderer.text(" ")
+            self.started = True
+            if "[" not in chunk :
+                if chunk :
+                    renderer.text(chunk)
+                continue
+            for i, piece in enumerate(FORMATTING_CODES.split(chunk)) :
+                if i % 2 :
+                    renderer.code(piece)
+                elif piece :
+                    renderer.text(piece)
+    def finish(self) :
+        """Returns the output for what was written since the last
+        finish, and starts over."""
+        self.started = False
+        return self.renderer.finish()
+    def combine(self, outputs) :
+        return self.renderer.combine(outputs)
+
+class HTMLRenderer(object) :
+    """Renders the output as a paragraph of HTML."""
+    CODES = {"newline" : "</p><p>", "break" : "<br>", "indent" : "&nbsp;&nbsp;"}
+    def __init__(self) :
+        self.parts = []
+    def text(self, s) :
+        self.parts.append(s)
+    def code(self, name) :
+        self.parts.append(self.CODES[name])
+    def finish(self) :
+        out = "<p>"+"".join(self.parts)+"</p>"
+        self.parts = []
+        return out
+    def combine(self, outputs) :
+        return "".join(outputs)
+
+WHITESPACE = re.compile(r"\s+")
+HTML_TAG = re.compile("<[^<]+?>")
+
+class TextRenderer(object) :
+    """Renders the output as plain text for a terminal.  Whitespace is
+    collapsed, HTML is stripped out, and the paragraphs are wrapped
+    with textwrap."""
+    def __init__(self) :
+        self.paragraphs = []
+        self.parts = []
+        self.space = False # whether the text so far ends with collapsed whitespace
+    def text(self, s) :
+        s = WHITESPACE.sub(" ", s)
+        if self.space and s.startswith(" ") :
+            s = s[1:]
+        if s :
+            self.space = s.endswith(" ")
+            self.parts.append(HTML_TAG.sub("", s))
+    def code(self, name) :
+        self.space = False
+        if name == "indent" :
+            self.parts.append("  ")
+        else :
+            self.paragraphs.append("".join(self.parts))
+            self.parts = []
+            if name == "newline" :
+                self.paragraphs.append("")
+    def finish(self) :
+        self.paragraphs.append("".join(self.parts))
+        out = "\n".join(["\n".join(textwrap.wrap(p)) for p in self.paragraphs])
+        self.paragraphs = []
+        self.parts = []
+        self.space = False
+        return out
+    def combine(self, outputs) :
+        return "\n".join(outputs)
+
+class JSONEventRenderer(object) :
+    """Renders the output as a JSON list of events, which are either
+    {"text" : s} or {"code" : name}, for clients which do their own
+    formatting."""
+    def __init__(self) :
+        self.events = []
+    def text(self, s) :
+        if self.events and "text" in self.events[-1] :
+            self.events[-1]["text"] += s
+        else :
+            self.events.append({"text" : s})
+    def code(self, name) :
+        self.events.append({"code" : name})
+    def finish(self) :
+        out = json.dumps(self.events)
+        self.events = []
+        return out
+    def combine(self, outputs) :
+        return json.dumps([event for out in outputs for event in json.loads(out)])
@@ -28,15 +28,18 @@ from textadv.core.patterns import VarPattern, AbstractPattern
 from textadv.core.rulesystem import ActivityTable, ActionHandled
 from textadv.gamesystem.utilities import list_append, docstring
 from textadv.gamesystem.basicpatterns import *
-from textadv.gamesystem.actionsystem import BasicAction, IllogicalNotVisible
+from textadv.gamesystem.actionsystem import BasicAction, IllogicalNotVisible, MultipleObjects
 
 ###
 ### Parser exceptions
 ###
 
 class NoSuchWord(Exception) :
-    def __init__(self, word) :
+    """Suggestions is a list of known words which are spelled like
+    the word."""
+    def __init__(self, word, suggestions=()) :
         self.word = word
+        self.suggestions = suggestions
 
 class NoUnderstand(Exception) :
     pass
@@ -57,12 +60,45 @@ class Ambiguous(Exception) :
 ### Useful functions
 ###
 
+def chain_results(xs) :
+    """The accumulator for subparsers and parse_thing.  It chains
+    the results of the handlers lazily, so they are only produced
+    as they are needed."""
+    return itertools.chain.from_iterable(xs)
+
+def attempt_parse(parse, text) :
+    """Calls parse on the text.  Returns a function which gives back
+    the result (or raises the parser exception again) along with
+    whether the text failed to parse with NoSuchWord or
+    NoUnderstand."""
+    try :
+        result = parse(text)
+    except (NoSuchWord, NoUnderstand) as ex :
+        def _failed() :
+            raise ex
+        return _failed, True
+    except (NoInput, Ambiguous) as ex :
+        def _raised() :
+            raise ex
+        return _raised, False
+    return (lambda : result), False
+
+def first_or_none(results) :
+    if results :
+        return results[0]
+    else :
+        return None
+
 def product(xs, ys) :
-    out = []
+    """Generates x+y for each x in xs and y in ys.  Since ys is
+    usually what a continuation returned (which may be a generator),
+    it is only made into a list when there is more than one x."""
+    xs = list(xs)
+    if len(xs) > 1 :
+        ys = list(ys)
     for x in xs :
         for y in ys :
-            out.append(x+y)
-    return out
+            yield x+y
 
 def separate_object_words(words) :
     """Takes a list of words as returned by Words(ob), and segments
@@ -76,6 +112,11 @@ def separate_object_words(words) :
             adjs.append(w.lower())
     return (adjs,nouns)
 
+def object_parser_name(o, ctxt) :
+    """The evaluated Name of o with its whitespace normalized, which
+    is what an exact match of the input is compared against."""
+    return " ".join(ctxt.stringeval.eval_str(ctxt.world.get_property("Name", o), ctxt).split())
+
 def parser_valid_description(myadjs, mynouns, objadjs, objnouns) :
     """Checks whether (myadjs, mynouns) is a valid description for
     (objadjs,objnouns)."""
@@ -89,17 +130,115 @@ def parser_valid_description(myadjs, mynouns, objadjs, objnouns) :
             return False
     return True
 
+def edit_distance(a, b) :
+    """The number of insertions, deletions, substitutions, and
+    transpositions of adjacent letters it takes to turn a into b."""
+    prev2 = None
+    prev = range(len(b) + 1)
+    for i in xrange(1, len(a) + 1) :
+        cur = [i]
+        for j in xrange(1, len(b) + 1) :
+            d = min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + (a[i-1] != b[j-1]))
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1] :
+                d = min(d, prev2[j-2] + 1)
+            cur.append(d)
+        prev2, prev = prev, cur
+    return prev[-1]
+
+def one_letter_deletions(word) :
+    return [word] + [word[:i] + word[i+1:] for i in xrange(len(word))]
+
+class SpellingIndex(object) :
+    """Finds the words closest to a misspelled word.  Each word is
+    indexed under itself and under each way of deleting one of its
+    letters.  Two words share a key when one letter edit (or a
+    transposition) turns one into the other, so a lookup is one dict
+    access per letter of the misspelled word.  Punctuation and words
+    shorter than SPELLING_MIN_LENGTH are not indexed, since nearly
+    every typo is one edit away from them."""
+    __slots__ = ("words", "deletions")
+    def __init__(self) :
+        self.words = set()
+        self.deletions = dict() # deleted word -> set of words
+    def add(self, word) :
+        if len(word) < SPELLING_MIN_LENGTH or not word.isalpha() :
+            return
+        if word not in self.words :
+            self.words.add(word)
+            for key in one_letter_deletions(word) :
+                self.deletions.setdefault(key, set()).add(word)
+    def nearest(self, word, limit=3) :
+        """Gets at most limit words which are close to word, nearest
+        first."""
+        found = set()
+        for key in one_letter_deletions(word) :
+            found.update(self.deletions.get(key, EMPTY_SET))
+        found.discard(word)
+        return [w for d, w in sorted((edit_distance(word, w), w) for w in found)[:limit]]
+
+class Vocabulary(object) :
+    """An inverted index from words to the objects they describe,
+    split into adjectives and nouns.  The entry for an object is
+    replaced only when its Words change.  New words are also added to
+    the spelling index, if one is given."""
+    __slots__ = ("words", "adjs", "nouns", "spelling")
+    def __init__(self, spelling=None) :
+        self.words = dict() # object -> (Words list, (adjs, nouns))
+        self.adjs = dict() # word -> set of objects
+        self.nouns = dict() # word -> set of objects
+        self.spelling = spelling
+    def set_words(self, o, words) :
+        """Indexes the object o under words (as returned by
+        Words(o)).  Returns (adjs, nouns) as separate_object_words
+        would."""
+        old = self.words.get(o)
+        if old is not None :
+            if old[0] == words :
+                return old[1]
+            self.remove(o)
+        adjs, nouns = separated = separate_object_words(words)
+        self.words[o] = (list(words), separated)
+        for w in adjs :
+            self.adjs.setdefault(w, set()).add(o)
+        for w in nouns :
+            self.nouns.setdefault(w, set()).add(o)
+        if self.spelling is not None :
+            for w in adjs + nouns :
+                self.spelling.add(w)
+        return separated
+    def remove(self, o) :
+        words, (adjs, nouns) = self.words.pop(o)
+        for w in adjs :
+            self.adjs[w].discard(o)
+        for w in nouns :
+            self.nouns[w].discard(o)
+    def objects_with_word(self, word) :
+        """Gets the objects for which word is an adjective or a
+        noun."""
+        return self.adjs.get(word, EMPTY_SET) | self.nouns.get(word, EMPTY_SET)
+    def has_word(self, word) :
+        return bool(self.adjs.get(word) or self.nouns.get(word))
+
 ###
 ### Basically constant constants
 ###
 
 PARSER_ARTICLES = ["a", "an", "the", "some"]
+PARSER_ALL_WORDS = ["all", "everything"]
+PARSER_EXCEPT_WORDS = ["but", "except"]
+PARSER_LIST_WORDS = [",", "and"]
+PARSER_FUNCTION_WORDS = set(PARSER_ARTICLES + PARSER_ALL_WORDS + PARSER_EXCEPT_WORDS + PARSER_LIST_WORDS)
+
+SPELLING_MIN_LENGTH = 3
+
+EMPTY_SET = frozenset()
 
 ###
 ### Matched objects
 ###
 
 class Matched(object) :
+    __slots__ = ("words", "value", "score", "var", "subparser", "subobjects", "supdata")
     def __init__(self, words, value, score, subparser, var=None, subobjects=None) :
         self.words = words
         self.value = value
@@ -107,15 +246,95 @@ class Matched(object) :
         self.var = var
         self.subparser = subparser
         self.subobjects = subobjects
+        self.supdata = None
     def __repr__(self) :
         return "Matched(%r,%r,%r,%r,%r,%r)" % (self.words, self.value, self.score,
                                                self.subparser, self.var, self.subobjects)
 
 
+###
+### For the chart in run_subparser
+###
+
+class ChartEnd(object) :
+    """Marks the position at which a subparser stopped matching."""
+    __slots__ = ("i",)
+    def __init__(self, i) :
+        self.i = i
+    def __repr__(self) :
+        return "ChartEnd(%r)" % self.i
+
+def chart_end(i) :
+    """The continuation used to find what a subparser matches."""
+    return [[ChartEnd(i)]]
+
+class ChartEntry(object) :
+    """The (matched, end) spans of what a subparser matches from a
+    position.  The spans are taken from the subparser's parses (which
+    ended with chart_end) as they are first needed, and they are kept
+    for whatever else iterates over the entry."""
+    __slots__ = ("spans", "parses")
+    def __init__(self, parses) :
+        self.spans = []
+        self.parses = iter(parses)
+    def __iter__(self) :
+        spans = self.spans
+        n = 0
+        while True :
+            if n == len(spans) :
+                if self.parses is None :
+                    return
+                try :
+                    r = next(self.parses)
+                except StopIteration :
+                    self.parses = None
+                    return
+                spans.append((r[:-1], r[-1].i))
+            yield spans[n]
+            n += 1
+
+
 ###
 ### For the "understand" method.
 ###
 
+class RuleTrie(object) :
+    """Indexes the handlers made by understand by the literal words
+    at the start of their patterns.  Each node is a pair (dict of word
+    -> node, set of handlers whose leading words end there)."""
+    __slots__ = ("handlers", "root")
+    def __init__(self) :
+        self.handlers = set()
+        self.root = (dict(), set())
+    def add(self, parts, handler) :
+        self.handlers.add(handler)
+        nodes = [self.root]
+        for part in parts :
+            if type(part) is not list :
+                break
+            nodes = [node[0].setdefault(word, (dict(), set())) for node in nodes for word in part]
+        for node in nodes :
+            node[1].add(handler)
+    def skipped(self, input, i) :
+        """Gets the handlers whose leading words do not match the
+        input starting at i."""
+        found = set(self.root[1])
+        node = self.root
+        while i < len(input) :
+            node = node[0].get(input[i].lower())
+            if node is None :
+                break
+            found.update(node[1])
+            i += 1
+        return self.handlers - found
+    def copy(self) :
+        def copy_node(node) :
+            return (dict((word, copy_node(child)) for word, child in node[0].iteritems()), set(node[1]))
+        newtrie = RuleTrie()
+        newtrie.handlers = set(self.handlers)
+        newtrie.root = copy_node(self.root)
+        return newtrie
+
 class CallSubParser(object) :
     def __init__(self, name, var=None) :
         self.name = name
@@ -131,12 +350,17 @@ class CallSubParser(object) :
 
 class Parser(object) :
     def __init__(self) :
-        self.KNOWN_WORDS = []
+        self.KNOWN_WORDS = set()
+        self.spelling = SpellingIndex() # the known words and the words of objects
         self.add_known_words(*PARSER_ARTICLES)
         # subparser takes (parser, var, input, i, ctxt, actor, next)
         self.subparsers = dict()
         self.object_classes = {"something" : "thing", "somewhere" : "room"}
-        self.parse_thing = ActivityTable(accumulator=list_append, doc="""A
+        self.vocabulary = Vocabulary(self.spelling)
+        self.chart = None # (subparser, var, i, actor) -> ChartEntry during run_parser
+        self.rule_tries = dict() # subparser -> RuleTrie of the understand handlers
+        self.rules_tried = 0 # number of subparser handlers run for the current command
+        self.parse_thing = ActivityTable(accumulator=chain_results, doc="""A
         parse_thing parser takes the arguments (parser, subparser,
         var, name, words, input, i, ctxt, next, multiplier=1), and
         then tries to parse the input from the point of view of the
@@ -144,24 +368,77 @@ class Parser(object) :
         the name of the subparser which called parse_thing so that we
         can disambiguate properly.  Note: this may be backwards from
         what is expected--we try to find the thing we're looking for
-        rather than try to find any thing.  Should return
-        [Matched(..), ...] or something.""")
-    def init_current_objects(self, ctxt, with_objs=None) :
+        rather than try to find any thing.  Should return an iterable
+        of [Matched(..), ...], and the results of the handlers are
+        chained lazily.""")
+        self.object_scope = ActivityTable(accumulator=first_or_none, reverse=True, doc="""An
+        object_scope handler takes the arguments (parser, subparser,
+        kind, ctxt) and returns the objects which the subparser should
+        first try to match against, or raises NotHandled.  When no
+        handler gives a scope, the subparser uses every object of the
+        kind.  If nothing parses against the scope, the input is
+        parsed again against every object of the kind, so the
+        verifier can still say that something can't be seen.""")
+    def init_current_objects(self, ctxt, with_objs=None, use_scope=False) :
         """For parsing efficiency of things (needed in the something
-        parser).  Gets the referenceable objects and their words."""
+        parser).  Gets the referenceable objects and their words,
+        which are kept in the vocabulary index.  The evaluated names
+        are cached in the world across commands.  If use_scope is set,
+        then the objects are restricted to those given by
+        object_scope.  Returns whether any subparser was
+        restricted."""
         self.current_objects = dict()
         self.current_words = dict()
+        self.current_positions = dict()
         self.current_names = dict()
+        vocabulary = self.vocabulary
+        scoped = False
         for parser, kind in self.object_classes.iteritems() :
             if with_objs and parser in with_objs :
                 self.current_objects[parser] = with_objs[parser]
             else :
-                self.current_objects[parser] = ctxt.world.activity.objects_of_kind(kind)
-            self.current_words[parser] = [separate_object_words(ctxt.world.get_property("Words", o))
+                objects = ctxt.world.activity.objects_of_kind(kind)
+                if use_scope :
+                    scope = self.object_scope.notify([self, parser, kind, ctxt], {})
+                    if scope is not None :
+                        scope = set(scope)
+                        objects = [o for o in objects if o in scope]
+                        scoped = True
+                self.current_objects[parser] = objects
+            self.current_words[parser] = [vocabulary.set_words(o, ctxt.world.get_property("Words", o))
                                           for o in self.current_objects[parser]]
+            self.current_positions[parser] = dict((o, n) for n, o in enumerate(self.current_objects[parser]))
             self.current_names[parser] = dict()
             for o in self.current_objects[parser] :
-                self.current_names[parser][o] = " ".join(ctxt.stringeval.eval_str(ctxt.world.get_property("Name", o), ctxt).split())
+                self.current_names[parser][o] = ctxt.world.cached(("parser_name", o, ctxt.actor), object_parser_name, o, ctxt)
+        return scoped
+    def current_name(self, subparser, o, ctxt) :
+        """Gets the name of the object as it is written in the input.
+        Objects which are not in current_objects[subparser] (such as
+        the object of an [object x] outside of the scope) are named
+        when they are first asked about."""
+        names = self.current_names.setdefault(subparser, dict())
+        try :
+            return names[o]
+        except KeyError :
+            name = names[o] = ctxt.world.cached(("parser_name", o, ctxt.actor), object_parser_name, o, ctxt)
+            return name
+    def candidate_objects(self, subparser, input, i) :
+        """Gets the (object, words) pairs of current_objects[subparser]
+        which could be described by a noun phrase starting at input[i].
+        The first word after an optional article must be one of an
+        object's words, so only the objects it indexes in the
+        vocabulary are returned (in the order of current_objects)."""
+        if i < len(input) and input[i].lower() in PARSER_ARTICLES :
+            i += 1
+        if i >= len(input) :
+            return []
+        positions = self.current_positions[subparser]
+        found = sorted(positions[o] for o in self.vocabulary.objects_with_word(input[i].lower())
+                       if o in positions)
+        objects = self.current_objects[subparser]
+        words = self.current_words[subparser]
+        return [(objects[n], words[n]) for n in found]
     def add_object_class(self, parsername, kind) :
         """Sets up the object_classes dictionary for a subparser
         called parsername so that current_objects[parsername] will be
@@ -171,31 +448,87 @@ class Parser(object) :
     def add_known_words(self,*words) :
         """Helps let the user know which word was not recognized when
         they make a typo."""
-        self.KNOWN_WORDS.extend(words)
-    def __is_word_for_thing(self, word) :
-        for word_list in self.current_words.itervalues() :
-            for adjs,nouns in word_list :
-                if word in adjs or word in nouns :
-                    return True
-        return False
+        self.KNOWN_WORDS.update(words)
+        for word in words :
+            self.spelling.add(word)
+    def is_known_word(self, word) :
+        """Checks whether the word is a known word or is one of the
+        words of an object."""
+        word = word.lower()
+        return word in self.KNOWN_WORDS or self.vocabulary.has_word(word)
+    def suggest_words(self, word, limit=3) :
+        """Gets the known words which are spelled most like the
+        word.  A function word like "all" or "the" is left out when
+        the word of an object or a verb is at least as close."""
+        word = word.lower()
+        found = [(edit_distance(word, w), w in PARSER_FUNCTION_WORDS, w)
+                 for w in self.spelling.nearest(word, limit=limit+5)
+                 if self.is_known_word(w)]
+        content = [d for d, function, w in found if not function]
+        return [w for d, function, w in sorted(found)
+                if not (function and content and min(content) <= d)][:limit]
 
     def define_subparser(self, name, doc=None) :
-        self.subparsers[name] = ActivityTable(accumulator=list_append, doc=doc)
+        """Defines a subparser.  A subparser handler takes (parser,
+        var, input, i, ctxt, actor, next) and returns an iterable of
+        its parses, each a list of Matched followed by what next
+        returned for where the match stopped.  Both the handlers and
+        next may return generators, so the parses are only produced
+        as they are needed."""
+        self.subparsers[name] = ActivityTable(accumulator=chain_results, doc=doc)
     def add_subparser(self, name, **kwargs) :
         def _add_subparser(f) :
             self.subparsers[name].add_handler(f, **kwargs)
             return f
         return _add_subparser
+    def notify_subparser(self, name, var, input, i, ctxt, actor, next) :
+        """Runs the handlers of the subparser, except for those made by
+        understand whose leading words don't match the input at i."""
+        table = self.subparsers[name]
+        trie = self.rule_tries.get(name)
+        if trie is None :
+            skip = None
+            self.rules_tried += len(table.actions)
+        else :
+            skip = trie.skipped(input, i)
+            self.rules_tried += len(table.actions) - len(skip)
+        return table.notify([self, var, input, i, ctxt, actor, next], {}, skip=skip)
     def run_subparser(self, name, var, input, i, ctxt, actor, next) :
-        return self.subparsers[name].notify([self, var, input, i, ctxt, actor, next], {})
-    def run_parser(self, name, input, ctxt) :
-        """Like run_subparser, but matches the end of input, too."""
+        """Runs the subparser from position i, continuing with next
+        wherever it stops.  During run_parser, what a subparser
+        matches from a position is kept in the chart, so alternatives
+        which reach the same subparser at the same position share the
+        work.  The parses are generated lazily."""
+        chart = self.chart
+        if chart is None :
+            return self.notify_subparser(name, var, input, i, ctxt, actor, next)
+        key = (name, var, i, actor)
+        try :
+            spans = chart[key]
+        except KeyError :
+            spans = chart[key] = ChartEntry(self.notify_subparser(name, var, input, i, ctxt, actor, chart_end))
+        except TypeError : # unhashable actor
+            return self.notify_subparser(name, var, input, i, ctxt, actor, next)
+        return (matched + r for matched, i2 in spans for r in next(i2))
+    def iter_parser(self, name, input, ctxt) :
+        """Like run_subparser, but matches the end of input, too.
+        Generates the parses lazily, using a new chart for the input
+        until they are all generated (or the generator is closed)."""
         def _end(i) :
             if len(input) == i :
                 return [[]]
             else :
                 return []
-        return self.subparsers[name].notify([self, None, input, 0, ctxt, ctxt.actor, _end], {})
+        chart = self.chart
+        self.chart = dict()
+        try :
+            for r in self.notify_subparser(name, None, input, 0, ctxt, ctxt.actor, _end) :
+                yield r
+        finally :
+            self.chart = chart
+    def run_parser(self, name, input, ctxt) :
+        """Gets the list of the parses from iter_parser."""
+        return list(self.iter_parser(name, input, ctxt))
 
     def understand(self, text, result=None, dest="action") :
         """Takes a textual form of a command and adds it to the parser
@@ -258,9 +591,9 @@ class Parser(object) :
                     return _handler_part(part_i+1, var, input, i3)
                 if part_i == len(parts) :
                     # we've matched all of our parts, so return (with
-                    # extra data at the end so we can construct the
-                    # proper Matched object)
-                    return [[(i2, next(i2))]]
+                    # where we stopped at the end so we can construct
+                    # the proper Matched object)
+                    return [[ChartEnd(i2)]]
                 elif type(parts[part_i]) is CallSubParser :
                     # or, we have a subparser to execute
                     csp = parts[part_i]
@@ -273,11 +606,9 @@ class Parser(object) :
                     return _handler_part(part_i+1, var, input, i2+1)
                 else :
                     return []
-            res = _handler_part(0, var, input, i)
-            out = []
-            # We need to massage the data to handle the last tuple.
-            for r in res :
-                i2, rest = r[-1]
+            # We need to massage the data to handle the ChartEnd.
+            for r in _handler_part(0, var, input, i) :
+                i2 = r[-1].i
                 subobjects = r[:-1]
                 score = 0
                 matches = dict()
@@ -306,86 +637,158 @@ class Parser(object) :
                     value = subobjects
                 m = Matched(input[i:i2], value, score, dest, var=var, subobjects=subobjects)
                 m.supdata = supdata # hack!!! We need this to disambiguate properly
-                out.extend(product([[m]], rest))
-            return out
+                for r in next(i2) :
+                    yield [m] + r
+        self.rule_tries.setdefault(dest, RuleTrie()).add(parts, _handler_sequence)
+
+    def split_commands(self, text, parse=None) :
+        """Generates (command, parsed) pairs for the commands in a
+        line of input, which are separated by periods (at the ends of
+        words) or the word "then".  There is always at least one
+        command, which is empty if the line has none.
+
+        Since names may have periods in them (like "Irving Q. Tep"),
+        if parse is given (a function like handle_all of just the
+        text), then a command followed by a period is parsed when it
+        is reached, and if that fails with NoSuchWord or NoUnderstand
+        it is joined with the commands after it if that makes it
+        parse.  For such a command, parsed is a function which gives
+        back the result of the parse (or raises its exception again)
+        so that it needn't be parsed twice, and otherwise it is None.
+        The commands are generated lazily so that each is parsed just
+        before it is run."""
+        parts = re.split(r"(\.(?=\s|$)|\bthen\b)", text, flags=re.IGNORECASE)
+        pieces, separators = parts[0::2], parts[1::2]
+        last = max([n for n, piece in enumerate(pieces) if piece.strip()] or [0])
+        n = 0
+        while n <= last :
+            command = pieces[n].strip()
+            end = n
+            parsed = None
+            if parse is not None and command and n < last and separators[n] == "." :
+                parsed, failed = attempt_parse(parse, command)
+                if failed :
+                    joined = pieces[n]
+                    for n2 in xrange(n+1, last+1) :
+                        joined += separators[n2-1] + pieces[n2]
+                        joined_parsed, failed = attempt_parse(parse, joined.strip())
+                        if not failed :
+                            command, parsed, end = joined.strip(), joined_parsed, n2
+                            break
+            if command or last == 0 :
+                yield command, parsed
+            n = end + 1
 
     def transform_text_to_words(self, text) :
         text = text.replace(",", " , ")
         return text.split()
 
     def handle_all(self, input, ctxt, action_verifier) :
+        """Parses and disambiguates the input, where action_verifier
+        is as in disambiguate.  This is all done in a memo scope of
+        the world, since parsing does not change the world."""
+        self.rules_tried = 0
+        ctxt.world.begin_memo()
+        try :
+            return self.__handle_all(input, ctxt, action_verifier)
+        finally :
+            ctxt.world.end_memo()
+    def __handle_all(self, input, ctxt, action_verifier) :
         words = self.transform_text_to_words(input)
         if not words :
             raise NoInput()
-        self.init_current_objects(ctxt)
-        results = [r[0] for r in self.run_parser("action", words, ctxt)]
-        if not results :
+        scoped = self.init_current_objects(ctxt, use_scope=True)
+        results = self.iter_parser("action", words, ctxt)
+        first = next(results, None)
+        if first is None and scoped :
+            # maybe the player is referring to something out of scope
+            self.init_current_objects(ctxt)
+            results = self.iter_parser("action", words, ctxt)
+            first = next(results, None)
+        if first is None :
             # then maybe we didn't know one of the words
             for word in words :
-                if word not in self.KNOWN_WORDS and not self.__is_word_for_thing(word) :
-                    raise NoSuchWord(word)
+                if not self.is_known_word(word) :
+                    raise NoSuchWord(word, self.suggest_words(word))
             raise NoUnderstand()
-        action, did_disambiguate = self.disambiguate(results, ctxt, action_verifier)
-        return (action, did_disambiguate)
+        try :
+            return self.disambiguate((r[0] for r in itertools.chain([first], results)), ctxt, action_verifier)
+        finally :
+            results.close()
 
     def disambiguate(self, results, ctxt, action_verifier) :
         """Try to disambiguate the results if needed using the
         action_verifier to get whether things work.  Returns (action,
         did_disambiguate) pair, where did_disambiguate represents
-        whether there were multiple logical options."""
-        if len(results) == 1 : # no need to disambiguate
-            return results[0].value, False
-        else : # it's ambiguous!
-            # first, see if verification helps at all
-            scores_pre = [(r, action_verifier(r.value, ctxt)) for r in results]
-            # we separate out the ones which are illogical because
-            # something wasn't visible because we don't want to even
-            # mention the objects involved (because they weren't
-            # visible).
-            scores = [(r, v) for r,v in scores_pre if type(v) is not IllogicalNotVisible]
-            if len(scores) == 0 :
-                # In this case, we are stuck with an invalid action
-                # because some item is not visible
-                scores_not_visible = [r for r,v in scores_pre if type(v) is IllogicalNotVisible]
-                # we say is_disambiguating=False so there is no
-                # disambiguation message
-                return scores_not_visible[0].value, False
-            scores.sort(key=lambda z : z[1].score)
-            is_disambiguating = 1 < len([True for r,v in scores if v.is_acceptible()])
-            if scores[-1][1].is_acceptible() :
-                # good, there is some acceptible action.
-                best_score = scores[-1][1].score
-                best_results = [r for r,v in scores if v.score >= best_score]
-                if len(best_results) == 1 : # good, the verification score saved us
-                    return best_results[0].value, is_disambiguating
-                else :
-                    # we assume that the order of the results
-                    # disambiguates potential multi-action result sets
-                    # (that is, we assume the order reflects the order
-                    # of parser definition).  We take the action
-                    # parsed by the last-defined parser
-                    ordered_best_results = [r for r in results if r in best_results]
-                    ordered_best_results.reverse()
-                    new_results = []
-                    for r in ordered_best_results :
-                        if type(r.value) is type(ordered_best_results[0].value) :
-                            new_results.append(r)
-                        else :
-                            break
-                    new_results.sort(key=lambda r : r.score)
-                    best_score = new_results[-1].score
-                    new_best_results = [r for r in new_results if r.score >= best_score]
-                    if len(new_best_results) == 1 : # good, the specificity score saved us
-                        return new_best_results[0].value, True
-                    else :
-                        # We need the user to disambiguate.  The
-                        # following returns the Ambiguous exception.
-                        raise self.__construct_amb_exception([r.value for r in new_best_results],
-                                                             [r.supdata for r in new_best_results])
-            else :
-                # well, none of them are acceptible.  Let's go for the
-                # worst one.
-                return scores[0][0].value, True
+        whether there were multiple logical options.  The results may
+        be any iterable of Matched objects.  The action_verifier takes
+        an action and the context and returns its verification (see
+        ActionSystem.verify_action).  The results are verified one at
+        a time, and only those which could still be chosen are kept."""
+        results = iter(results)
+        first = next(results)
+        second = next(results, None)
+        if second is None : # no need to disambiguate
+            return first.value, False
+        # it's ambiguous!  See if verification helps at all.  We
+        # separate out the ones which are illogical because something
+        # wasn't visible because we don't want to even mention the
+        # objects involved (because they weren't visible).
+        first_not_visible = None
+        num_acceptible = 0
+        worst = None # the first of the results with the lowest verification score
+        worst_verify = None
+        best_verify = None # the last of the highest verification scores
+        num_best = 0
+        # We assume that the order of the results disambiguates
+        # potential multi-action result sets (that is, we assume the
+        # order reflects the order of parser definition), and we take
+        # the action parsed by the last-defined parser.  So, run is
+        # the results with the highest verification score since the
+        # last change in the type of action, restricted to those with
+        # the highest parser score.
+        run = []
+        for r in itertools.chain([first, second], results) :
+            v = action_verifier(r.value, ctxt)
+            if type(v) is IllogicalNotVisible :
+                if first_not_visible is None :
+                    first_not_visible = r
+                continue
+            if v.is_acceptible() :
+                num_acceptible += 1
+            if worst is None or v.score < worst_verify.score :
+                worst, worst_verify = r, v
+            if best_verify is None or v.score > best_verify.score :
+                best_verify = v
+                num_best = 1
+                run = [r]
+            elif v.score == best_verify.score :
+                best_verify = v
+                num_best += 1
+                if type(r.value) is not type(run[-1].value) or r.score > run[-1].score :
+                    run = [r]
+                elif r.score == run[-1].score :
+                    run.append(r)
+        if best_verify is None :
+            # In this case, we are stuck with an invalid action
+            # because some item is not visible.  We say
+            # is_disambiguating=False so there is no disambiguation
+            # message
+            return first_not_visible.value, False
+        is_disambiguating = 1 < num_acceptible
+        if not best_verify.is_acceptible() :
+            # well, none of them are acceptible.  Let's go for the
+            # worst one.
+            return worst.value, True
+        if num_best == 1 : # good, the verification score saved us
+            return run[0].value, is_disambiguating
+        if len(run) == 1 : # good, the specificity score saved us
+            return run[0].value, True
+        # We need the user to disambiguate.  The following returns the
+        # Ambiguous exception.
+        run.reverse()
+        raise self.__construct_amb_exception([r.value for r in run],
+                                             [r.supdata for r in run])
     def __construct_amb_exception(self, results, supdata) :
         # It's ambiguous. Construct the possibilities for each argument
         def __construct_pattern(results, supdata, subparsers, to_replace, next_var) :
@@ -436,11 +839,14 @@ class Parser(object) :
 
     def copy(self) :
         newparser = Parser()
-        newparser.KNOWN_WORDS = list(self.KNOWN_WORDS)
+        newparser.add_known_words(*self.KNOWN_WORDS)
         for name, table in self.subparsers.iteritems() :
             newparser.subparsers[name] = table.copy()
         newparser.parse_thing = self.parse_thing.copy()
+        newparser.object_scope = self.object_scope.copy()
         newparser.object_classes = self.object_classes.copy()
+        for name, trie in self.rule_tries.iteritems() :
+            newparser.rule_tries[name] = trie.copy()
         return newparser
     def make_documentation(self, escape, heading_level=1) :
         hls = str(heading_level)
@@ -464,40 +870,40 @@ def default_parse_thing(parser, subparser, var, name, words, input, i, ctxt, nex
     using the grammar [art]? [adjs]* [noun]?, where there is at least
     one adjective or noun."""
     def match_adjs_nouns(curr_adjs, i2) :
-        poss = []
         if i2 < len(input) :
             # try adding another adjective
             if input[i2].lower() in adjs :
                 new_adjs = curr_adjs + [input[i2].lower()]
                 if parser_valid_description(new_adjs, [], adjs, nouns) :
-                    poss.extend(match_adjs_nouns(new_adjs, i2+1))
+                    for r in match_adjs_nouns(new_adjs, i2+1) :
+                        yield r
             # or try concluding with a noun
             if input[i2].lower() in nouns :
                 # already a match because input[i2] is one of the nouns.
                 m2 = 1
-                if parser.current_names[subparser][name] == " ".join(input[i:i2+1]) :
+                if parser.current_name(subparser, name, ctxt) == " ".join(input[i:i2+1]) :
                     m2 += 0.5
-                poss.extend(product([[Matched(input[i:i2+1], name, 2*multiplier*m2, subparser, var=var)]],
-                                    next(i2+1)))
+                for r in product([[Matched(input[i:i2+1], name, 2*multiplier*m2, subparser, var=var)]],
+                                 next(i2+1)) :
+                    yield r
         # or just try concluding
         if len(curr_adjs) > 0 :
             # already a match
             m2 = 1
-            if parser.current_names[subparser][name] == " ".join(input[i:i2]) :
+            if parser.current_name(subparser, name, ctxt) == " ".join(input[i:i2]) :
                 m2 += 0.5
-            poss.extend(product([[Matched(input[i:i2], name, 1*multiplier*m2, subparser, var)]],
-                                next(i2)))
-        return poss
+            for r in product([[Matched(input[i:i2], name, 1*multiplier*m2, subparser, var)]],
+                             next(i2)) :
+                yield r
     adjs,nouns = words
-    poss = []
     if i < len(input) :
         i2 = i
         # skip over articles
         if input[i].lower() in PARSER_ARTICLES :
             i2 += 1
             i += 1 # for bumping up score for exact matches
-        poss.extend(match_adjs_nouns([], i2))
-    return poss
+        for r in match_adjs_nouns([], i2) :
+            yield r
 
 
 default_parser.define_subparser("action", """A parser to match against entire
@@ -509,8 +915,62 @@ default_parser.define_subparser("something", "A parser to match against things i
 @default_parser.add_subparser("something")
 def default_something(parser, var, input, i, ctxt, actor, next) :
     """Tries to parse as if the following input were a thing."""
-    return list_append([parser.parse_thing.notify([parser, "something", var, name, words,input,i,ctxt,next],{})
-                        for name,words in zip(parser.current_objects["something"], parser.current_words["something"])])
+    return chain_results(parser.parse_thing.notify([parser, "something", var, name, words,input,i,ctxt,next],{})
+                         for name,words in parser.candidate_objects("something", input, i))
+
+
+default_parser.define_subparser("somethings", """A parser to match against
+several things in the game at once, as in "the lamp and the ball", "all",
+or "everything but the lamp".  The resulting Matched.value is a
+MultipleObjects.""")
+
+default_parser.add_known_words(*(PARSER_ALL_WORDS + PARSER_EXCEPT_WORDS + PARSER_LIST_WORDS))
+
+def parse_thing_list(parser, input, i, ctxt, actor) :
+    """Parses one or more things separated by commas and "and",
+    generating (matches, end) pairs, where matches is the list of
+    Matched for the things."""
+    for r in parser.run_subparser("something", None, input, i, ctxt, actor, chart_end) :
+        m, i2 = r[0], r[-1].i
+        yield ([m], i2)
+        i3 = i2
+        if i3 < len(input) and input[i3] == "," :
+            i3 += 1
+        if i3 < len(input) and input[i3].lower() == "and" :
+            i3 += 1
+        if i3 > i2 :
+            for ms, i4 in parse_thing_list(parser, input, i3, ctxt, actor) :
+                yield ([m] + ms, i4)
+
+@default_parser.add_subparser("somethings")
+def default_somethings_list(parser, var, input, i, ctxt, actor, next) :
+    """Parses a list of at least two different things."""
+    for ms, i2 in parse_thing_list(parser, input, i, ctxt, actor) :
+        objects = [m.value for m in ms]
+        if len(set(objects)) == len(objects) > 1 :
+            value = MultipleObjects(objects)
+            for r in product([[Matched(input[i:i2], value, sum(m.score for m in ms), "somethings", var=var)]],
+                             next(i2)) :
+                yield r
+
+@default_parser.add_subparser("somethings")
+def default_somethings_all(parser, var, input, i, ctxt, actor, next) :
+    """Parses "all" or "everything", optionally followed by "but" or
+    "except" and the things to leave out.  Which of the things the
+    "all" refers to is decided by ActionSystem.expand_action."""
+    if i >= len(input) or input[i].lower() not in PARSER_ALL_WORDS :
+        return
+    objects = parser.current_objects["something"]
+    for r in product([[Matched(input[i:i+1], MultipleObjects(objects, is_all=True), 1, "somethings", var=var)]],
+                     next(i+1)) :
+        yield r
+    if i+1 < len(input) and input[i+1].lower() in PARSER_EXCEPT_WORDS :
+        for ms, i2 in parse_thing_list(parser, input, i+2, ctxt, actor) :
+            excepted = set(m.value for m in ms)
+            value = MultipleObjects([o for o in objects if o not in excepted], is_all=True)
+            for r in product([[Matched(input[i:i2], value, 1, "somethings", var=var)]],
+                             next(i2)) :
+                yield r
 
 
 default_parser.define_subparser("somewhere", "A parser to match against rooms in the game.")
@@ -518,8 +978,8 @@ default_parser.define_subparser("somewhere", "A parser to match against rooms in
 @default_parser.add_subparser("somewhere")
 def default_somewhere(parser, var, input, i, ctxt, actor, next) :
     """Tries to parse as if the following input were a room."""
-    return list_append([parser.parse_thing.notify([parser, "somewhere", var, name, words,input,i,ctxt,next],{})
-                        for name,words in zip(parser.current_objects["somewhere"], parser.current_words["somewhere"])])
+    return chain_results(parser.parse_thing.notify([parser, "somewhere", var, name, words,input,i,ctxt,next],{})
+                         for name,words in parser.candidate_objects("somewhere", input, i))
 
 
 default_parser.define_subparser("object", "A parser which uses its variable as an object id, instead.")
@@ -537,8 +997,84 @@ default_parser.define_subparser("text", """Just matches against any sequence of
 def default_parse_text(parser, var, input, i, ctxt, actor, next) :
     """Parses any number of words, stopping at or before the end of
     the input."""
-    out = []
     for i2 in xrange(i+1,len(input)+1) :
-        out.extend(product([[Matched(input[i:i2], " ".join(input[i:i2]), 1, "text", var=var)]],
-                           next(i2)))
-    return out
+        for r in product([[Matched(input[i:i2], " ".join(input[i:i2]), 1, "text", var=var)]],
+                         next(i2)) :
+            yield r
+
+###
+### Tests
+###
+import unittest
+
+class TestParser(unittest.TestCase) :
+    def make_context(self) :
+        from textadv import basicsetup
+        from textadv.gamesystem.gamecontexts import ActorContext
+        ctxt = ActorContext(None, None, basicsetup.world.copy(), basicsetup.actionsystem.copy(),
+                            basicsetup.parser.copy(), basicsetup.stringeval.copy(),
+                            basicsetup.actoractivities.copy(), "player")
+        basicsetup.quickdef(ctxt.world, "hall", "room")
+        basicsetup.quickdef(ctxt.world, "cellar", "room")
+        ctxt.world.activity.put_in("player", "hall")
+        basicsetup.quickdef(ctxt.world, "rat", "thing", {basicsetup.Name : "big fat rat"}, put_in="cellar")
+        ctxt.parser.understand("catch [object rat]", basicsetup.Taking(basicsetup.actor, "rat"))
+        return ctxt
+
+    def test_object_out_of_scope(self) :
+        # the rat is not in the scope, but [object rat] still parses
+        from textadv.basicsetup import Taking
+        ctxt = self.make_context()
+        action, disambiguated = ctxt.parser.handle_all("catch rat", ctxt, ctxt.actionsystem.verify_action)
+        self.assertEqual(action, Taking("player", "rat"))
+        reason = ctxt.actionsystem.verify_action(action, ctxt).reason
+        self.assertEqual(ctxt.stringeval.eval_str(reason, ctxt), "You can see no such thing.")
+
+    def test_split_commands(self) :
+        parser = Parser()
+        self.assertEqual([c for c, parsed in parser.split_commands("take ball. drop ball then look.")],
+                         ["take ball", "drop ball", "look"])
+        self.assertEqual(list(parser.split_commands(" . ")), [("", None)])
+        # a command which doesn't parse is joined with the next one,
+        # and each command followed by a period is parsed only once
+        parsed_texts = []
+        def parse(text) :
+            parsed_texts.append(text)
+            if text.split()[-1] == "Q" :
+                raise NoUnderstand()
+            return text.upper()
+        commands = list(parser.split_commands("ask Irving Q. Tep about it. look then jump", parse))
+        self.assertEqual([c for c, parsed in commands], ["ask Irving Q. Tep about it", "look", "jump"])
+        self.assertEqual(commands[0][1](), "ASK IRVING Q. TEP ABOUT IT")
+        self.assertEqual(commands[1][1], None)
+        self.assertEqual(parsed_texts, ["ask Irving Q", "ask Irving Q. Tep about it"])
+
+    def test_suggest_words(self) :
+        ctxt = self.make_context()
+        ctxt.parser.understand("bounce [something x]", "bounced")
+        ctxt.parser.vocabulary.set_words("ball", ["ball"])
+        # "all" is as close to "bal" as "ball", but is a function word
+        self.assertEqual(ctxt.parser.suggest_words("bal"), ["ball"])
+        self.assertEqual(ctxt.parser.suggest_words("bounse"), ["bounce"])
+        # punctuation and one-letter words are not suggested
+        self.assertEqual(ctxt.parser.suggest_words("x"), [])
+        self.assertEqual(ctxt.parser.suggest_words("alll"), ["all", "ball"])
+
+    def test_lazy_parses(self) :
+        # a subparser with infinitely many parses
+        parser = Parser()
+        parser.define_subparser("action")
+        parser.define_subparser("number")
+        @parser.add_subparser("number")
+        def _number(parser, var, input, i, ctxt, actor, next) :
+            for n in itertools.count() :
+                for r in product([[Matched(input[i:i+1], n, 1, "number", var=var)]], next(i+1)) :
+                    yield r
+        parser.understand("pick [number n]", "picked")
+        class Context(object) :
+            actor = "player"
+        parses = parser.iter_parser("action", ["pick", "it"], Context())
+        self.assertEqual([r[0].subobjects[0].value for r in itertools.islice(parses, 3)], [0, 1, 2])
+
+if __name__=="__main__" :
+    unittest.main(verbosity=2)
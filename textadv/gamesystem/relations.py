@@ -3,12 +3,16 @@
 # Defining relations between objects.  Relations must be created at
 # the top level of a module!!!
 #
-# provides: make_many_to_one_relation, make_one_to_many_relation
+# provides: make_many_to_one_relation, make_one_to_many_relation,
+# make_many_to_many_relation, make_directed_many_to_many_relation,
+# make_freeform_relation
 
+from collections import OrderedDict
 from textadv.core.patterns import BasicPattern, VarPattern, NoMatchException, AbstractPattern
 from textadv.gamesystem.basicpatterns import *
 
 class Relation(BasicPattern) :
+    __slots__ = ()
     @staticmethod
     def setup_table() :
         """Returns data which supports this relation, which is to be
@@ -33,42 +37,185 @@ class Relation(BasicPattern) :
     @classmethod
     def dump(r, data) :
         raise NotImplementedError("Relation is abstract")
+    @classmethod
+    def save_table(r, data) :
+        """Returns what World.serialize pickles for data.  Whatever
+        can be made again from it (like indexes and caches) is left
+        out."""
+        raise NotImplementedError("Relation is abstract")
+    @classmethod
+    def load_table(r, saved) :
+        """Makes the data again from what save_table returned."""
+        raise NotImplementedError("Relation is abstract")
+    def match_row(self, row) :
+        """Matches self against the relation r(*row) without making
+        the relation object.  Raises NoMatchException on failure."""
+        if len(row) != len(self.args) :
+            raise NoMatchException(self, row)
+        matches = dict()
+        for myarg, value in zip(self.args, row) :
+            if isinstance(myarg, AbstractPattern) :
+                matches = myarg.match(value, matches=matches)
+            elif not (myarg == value) :
+                raise NoMatchException(myarg, value)
+        return matches
+
+class IndexedRows(object) :
+    """The table for ManyToManyRelation and FreeformRelation: a list
+    of argument tuples along with, for each position, a hash index
+    from values to the numbers of the rows with that value in that
+    position.  Removed rows are left as None until compact is called
+    when there are enough of them to make it worth renumbering (so
+    row numbers from candidates stay good until then).  A position
+    is no longer indexed once an unhashable value shows up there."""
+    def __init__(self, rows=()) :
+        self.rows = []
+        self.num_removed = 0
+        self.indexes = []
+        for row in rows :
+            self.add(row)
+    def add(self, row) :
+        n = len(self.rows)
+        self.rows.append(row)
+        while len(self.indexes) < len(row) :
+            self.indexes.append(dict())
+        for i, value in enumerate(row) :
+            if self.indexes[i] is not None :
+                try :
+                    self.indexes[i].setdefault(value, []).append(n)
+                except TypeError : # unhashable, so stop indexing this position
+                    self.indexes[i] = None
+    def remove(self, n) :
+        self.rows[n] = None
+        self.num_removed += 1
+    def compact(self) :
+        """Renumbers the rows if more than half of them have been
+        removed."""
+        if 2*self.num_removed > len(self.rows) :
+            self.__init__(list(self))
+    def __iter__(self) :
+        return (row for row in self.rows if row is not None)
+    def __len__(self) :
+        return len(self.rows) - self.num_removed
+    def candidates(self, args) :
+        """Returns the (n, row) pairs which might match a relation
+        with the given arguments, in the order they were added.  The
+        shortest index entry among the ground arguments is used."""
+        best = None
+        for index, value in zip(self.indexes, args) :
+            if index is not None and not isinstance(value, AbstractPattern) :
+                try :
+                    ns = index.get(value, ())
+                except TypeError :
+                    continue
+                if best is None or len(ns) < len(best) :
+                    best = ns
+        rows = self.rows
+        if best is None :
+            return [(n, row) for n, row in enumerate(rows) if row is not None]
+        else :
+            return [(n, rows[n]) for n in best if rows[n] is not None]
+    def copy(self) :
+        return IndexedRows(self)
+
+class PathCache(object) :
+    """The path_to cache for ManyToOneRelation and
+    OneToManyRelation.  It's an LRU cache from (a, b) to the path (or
+    None), holding at most size paths.  The cache also remembers which
+    nodes each path walked out of so that changing a node's edge only
+    forgets the paths through that node."""
+    def __init__(self, size) :
+        self.size = size
+        self.paths = OrderedDict() # (a,b) -> (path, walked nodes)
+        self.through = dict() # node -> set of (a,b)
+    def get(self, key) :
+        """Returns the cached path, raising KeyError if there isn't
+        one."""
+        entry = self.paths.pop(key)
+        self.paths[key] = entry # now the most recently used
+        return entry[0]
+    def put(self, key, path, walked) :
+        if key in self.paths :
+            self.__forget(key)
+        self.paths[key] = (path, walked)
+        for node in walked :
+            try :
+                self.through[node].add(key)
+            except KeyError :
+                self.through[node] = set([key])
+        while len(self.paths) > self.size :
+            self.__forget(next(iter(self.paths)))
+    def invalidate(self, node) :
+        """Forgets every path which walked out of node."""
+        for key in list(self.through.get(node, ())) :
+            self.__forget(key)
+    def __forget(self, key) :
+        path, walked = self.paths.pop(key)
+        for node in walked :
+            keys = self.through[node]
+            keys.discard(key)
+            if not keys :
+                del self.through[node]
+    def __len__(self) :
+        return len(self.paths)
+    def copy(self) :
+        new = PathCache(self.size)
+        new.paths = self.paths.copy()
+        new.through = dict((node, set(keys)) for node, keys in self.through.iteritems())
+        return new
 
 class ManyToOneRelation(Relation) :
     def __init__(self, a, b) :
         """There can only be one instance of R(a, X) for any X."""
-        self.args = [a, b]
-    @staticmethod
-    def setup_table() :
-        return [dict(), [], dict()] # rel,bounded,cache
+        self.args = (a, b)
+    path_cache_size = 1000
+    @classmethod
+    def setup_table(r) :
+        return [dict(), set(), PathCache(r.path_cache_size), dict()] # rel,bounded,cache,reverse (b -> a's in the order added)
     def add_relation(self, data) :
         a, b = self.args
-        rels,bounded,cache = data
-        data[2] = dict() # clear cache
+        rels,bounded,cache,reverse = data
         if a in bounded : # has 'a' been bounded already?
             raise Exception("Already in a "+type(self).__name__+" many-to-one relation", a)
-        bounded.append(a)
+        bounded.add(a)
+        cache.invalidate(a)
         rels[a] = b
+        try :
+            reverse[b][a] = None
+        except KeyError :
+            reverse[b] = OrderedDict([(a, None)])
     def remove_relation(self, data) :
         """b doesn't matter in a many-to-one relation"""
         a, b = self.args
         if type(b) is not VarPattern :
             raise Exception("Many-to-one relation requires b to be variable for removal", b)
-        rels,bounded,cache = data
-        data[2] = dict() # clear cache
+        rels,bounded,cache,reverse = data
         if a in bounded :
             bounded.remove(a)
-            del rels[a]
+            cache.invalidate(a)
+            old_b = rels.pop(a)
+            del reverse[old_b][a]
+            if not reverse[old_b] :
+                del reverse[old_b]
     def query_relation(self, data) :
-        rels,bounded,cache = data
+        rels,bounded,cache,reverse = data
         if isinstance(self.args[0], AbstractPattern) :
-            out = []
-            for a,b in rels.iteritems() :
-                try :
-                    out.append(self.match(type(self)(a,b)))
-                except NoMatchException :
-                    pass
-            return out
+            if isinstance(self.args[1], AbstractPattern) :
+                out = []
+                for a,b in rels.iteritems() :
+                    try :
+                        out.append(self.match(type(self)(a,b)))
+                    except NoMatchException :
+                        pass
+                return out
+            else : # so we can look up the a's for args[1] in the reverse index
+                out = []
+                for a in reverse.get(self.args[1], ()) :
+                    try :
+                        out.append(self.args[0].match(a))
+                    except NoMatchException :
+                        pass
+                return out
         else : # so we can try looking args[0] up directly
             try :
                 poss_b = rels[self.args[0]]
@@ -86,65 +233,104 @@ class ManyToOneRelation(Relation) :
     @classmethod
     def path_to(r, data, a, b) :
         """Does an optimized search by just walking up the
-        hierarchy."""
-        rels,bounded,cache = data
+        hierarchy.  The cached path depends on the nodes walked out
+        of, which is all but the last."""
+        rels,bounded,cache,reverse = data
+        key = (a, b)
         try : # check the cache!
-            return list(cache[a][b])
+            path = cache.get(key)
+            return None if path is None else list(path)
         except KeyError :
             pass # too bad.
         out = [a]
         while a != b :
             if not rels.has_key(a) :
+                cache.put(key, None, out)
                 return None
             a = rels[a]
             out.append(a)
-        if not cache.has_key(a) :
-            cache[a] = dict()
-        cache[a][b] = out
+        cache.put(key, tuple(out), out[:-1])
         return out
     @classmethod
     def copy(r, data) :
-        return [data[0].copy(), list(data[1]), dict()]
+        return [data[0].copy(), set(data[1]), data[2].copy(), dict((b, s.copy()) for b,s in data[3].iteritems())]
     @classmethod
     def dump(r, data) :
         for a,b in data[0].iteritems() :
             print "%s(%r, %r)" % (r.__name__, a, b)
+    @classmethod
+    def save_table(r, data) :
+        """Saves the reverse index (which keeps the order the
+        relations were added in) and the order of the a's in rel.
+        The rest of the table is made again from these."""
+        return (list(data[0]), [(b, list(s)) for b, s in data[3].iteritems()])
+    @classmethod
+    def load_table(r, saved) :
+        order, buckets = saved
+        data = r.setup_table()
+        rels,bounded,cache,reverse = data
+        owners = dict()
+        for b, s in buckets :
+            reverse[b] = OrderedDict((a, None) for a in s)
+            for a in s :
+                owners[a] = b
+        for a in order : # so rel iterates in the same order as before
+            rels[a] = owners[a]
+        bounded.update(order)
+        return data
 
 class OneToManyRelation(Relation) :
     def __init__(self, a, b) :
         """There can only be one instance of R(X, b) for any X."""
-        self.args = [a, b]
-    @staticmethod
-    def setup_table() :
-        return [dict(), [], dict()]
+        self.args = (a, b)
+    path_cache_size = 1000
+    @classmethod
+    def setup_table(r) :
+        return [dict(), set(), PathCache(r.path_cache_size), dict()] # rel,bounded,cache,reverse (a -> b's in the order added)
     def add_relation(self, data) :
         a, b = self.args
-        rels,bounded,cache = data
-        data[2] = dict() # clear cache
+        rels,bounded,cache,reverse = data
         if b in bounded :
             raise Exception("Already in a "+type(self).__name__+" many-to-one relation", b)
-        bounded.append(b)
+        bounded.add(b)
+        cache.invalidate(b)
         rels[b] = a
+        try :
+            reverse[a][b] = None
+        except KeyError :
+            reverse[a] = OrderedDict([(b, None)])
     def remove_relation(self, data) :
         """b doesn't matter in a many-to-one relation"""
         a, b = self.args
         if type(a) is not VarPattern :
             raise Exception("One-to-many relation requires a to be variable for removal", b)
-        rels,bounded,cache = data
-        data[2] = dict() # clear cache
+        rels,bounded,cache,reverse = data
         if b in bounded :
             bounded.remove(b)
-            del rels[b]
+            cache.invalidate(b)
+            old_a = rels.pop(b)
+            del reverse[old_a][b]
+            if not reverse[old_a] :
+                del reverse[old_a]
     def query_relation(self, data) :
-        rels,bounded,cache = data
+        rels,bounded,cache,reverse = data
         if isinstance(self.args[1], AbstractPattern) :
-            out = []
-            for b,a in rels.iteritems() :
-                try :
-                    out.append(self.match(type(self)(a,b)))
-                except NoMatchException :
-                    pass
-            return out
+            if isinstance(self.args[0], AbstractPattern) :
+                out = []
+                for b,a in rels.iteritems() :
+                    try :
+                        out.append(self.match(type(self)(a,b)))
+                    except NoMatchException :
+                        pass
+                return out
+            else : # so we can look up the b's for args[0] in the reverse index
+                out = []
+                for b in reverse.get(self.args[0], ()) :
+                    try :
+                        out.append(self.args[1].match(b))
+                    except NoMatchException :
+                        pass
+                return out
         else : # so we can try looking args[0] up directly
             try :
                 poss_a = rels[self.args[1]]
@@ -161,28 +347,49 @@ class OneToManyRelation(Relation) :
                 return []
     @classmethod
     def path_to(r, data, a, b) :
-        rels,bounded,cache = data
+        rels,bounded,cache,reverse = data
+        key = (a, b)
         try : # check the cache!
-            return list(cache[a][b])
+            path = cache.get(key)
+            return None if path is None else list(path)
         except KeyError :
             pass # too bad.
         out = [b]
         while a != b :
             if not rels.has_key(b) :
+                cache.put(key, None, out)
                 return None
             b = rels[b]
             out.insert(0,b)
-        if not cache.has_key(a) :
-            cache[a] = dict()
-        cache[a][b] = out
+        cache.put(key, tuple(out), out[1:])
         return out
     @classmethod
     def copy(r, data) :
-        return [data[0].copy(), list(data[1]), dict()]
+        return [data[0].copy(), set(data[1]), data[2].copy(), dict((a, s.copy()) for a,s in data[3].iteritems())]
     @classmethod
     def dump(r, data) :
         for b,a in data[0].iteritems() :
             print "%s(%r, %r)" % (r.__name__, a, b)
+    @classmethod
+    def save_table(r, data) :
+        """Saves the reverse index (which keeps the order the
+        relations were added in) and the order of the b's in rel.
+        The rest of the table is made again from these."""
+        return (list(data[0]), [(a, list(s)) for a, s in data[3].iteritems()])
+    @classmethod
+    def load_table(r, saved) :
+        order, buckets = saved
+        data = r.setup_table()
+        rels,bounded,cache,reverse = data
+        owners = dict()
+        for a, s in buckets :
+            reverse[a] = OrderedDict((b, None) for b in s)
+            for b in s :
+                owners[b] = a
+        for b in order : # so rel iterates in the same order as before
+            rels[b] = owners[b]
+        bounded.update(order)
+        return data
 
 class ManyToManyRelation(Relation) :
     def __init__(self, a, b) :
@@ -190,28 +397,27 @@ class ManyToManyRelation(Relation) :
         relation is commutative unless the is_commutative staticmethod
         is overridden.  Commutativity is handled by adding both R(a,b)
         and R(b,a) to the database."""
-        self.args = [a, b]
+        self.args = (a, b)
     @staticmethod
     def setup_table() :
-        return []
+        return IndexedRows()
     def add_relation(self, data) :
-        data.append(self.args)
+        data.add(self.args)
         if self.is_commutative() :
-            data.append((self.args[1], self.args[0]))
+            data.add((self.args[1], self.args[0]))
     def remove_relation(self, data) :
-        commutative = self.is_commutative()
-        i = 0
-        while i < len(data) :
+        for n, row in data.candidates(self.args) :
             try :
-                self.match(type(self)(*data[i]))
-                del data[i] # implicit i++
+                self.match_row(row)
+                data.remove(n)
             except NoMatchException :
-                i += 1
+                pass
+        data.compact()
     def query_relation(self, data) :
         out = []
-        for r in data :
+        for n, row in data.candidates(self.args) :
             try :
-                out.append(self.match(type(self)(*r)))
+                out.append(self.match_row(row))
             except NoMatchException :
                 pass
         return out
@@ -223,11 +429,11 @@ class ManyToManyRelation(Relation) :
         """Breadth-first search.  The predicate is a filter on the
         vertex set."""
         paths = {a : [a]}
-        seen = []
+        seen = set()
         to_visit = [a]
         while to_visit :
             visiting = to_visit.pop(0)
-            seen.append(visiting)
+            seen.add(visiting)
             neighbors = [res["x"] for res in r(visiting, X).query_relation(data)]
             for n in neighbors :
                 if (n not in seen) and predicate(n) :
@@ -239,11 +445,17 @@ class ManyToManyRelation(Relation) :
         return None
     @classmethod
     def copy(r, data) :
-        return list(data)
+        return data.copy()
     @classmethod
     def dump(r, data) :
         for rel in data :
             print repr(r(*rel))
+    @classmethod
+    def save_table(r, data) :
+        return list(data)
+    @classmethod
+    def load_table(r, saved) :
+        return IndexedRows(saved)
 
 class DirectedManyToManyRelation(ManyToManyRelation) :
     @staticmethod
@@ -257,32 +469,38 @@ class FreeformRelation(Relation) :
         self.args = args
     @staticmethod
     def setup_table() :
-        return []
+        return IndexedRows()
     def add_relation(self, data) :
-        data.append(self.args)
+        data.add(self.args)
     def remove_relation(self, data) :
-        i = 0
-        while i < len(data) :
+        for n, row in data.candidates(self.args) :
             try :
-                self.match(type(self)(*data[i]))
-                del data[i] # implicit i++
+                self.match_row(row)
+                data.remove(n)
             except NoMatchException :
-                i += 1
+                pass
+        data.compact()
     def query_relation(self, data) :
         out = []
-        for r in data :
+        for n, row in data.candidates(self.args) :
             try :
-                out.append(self.match(type(self)(*r)))
+                out.append(self.match_row(row))
             except NoMatchException :
                 pass
         return out
     @classmethod
     def copy(r, data) :
-        return list(data)
+        return data.copy()
     @classmethod
     def dump(r, data) :
         for rel in data :
             print repr(r(*rel))
+    @classmethod
+    def save_table(r, data) :
+        return list(data)
+    @classmethod
+    def load_table(r, saved) :
+        return IndexedRows(saved)
 
 
 def __fix_module_name(cls) :
@@ -329,3 +547,59 @@ def make_freeform_relation(numargs, name) :
     _NewFreeformRelation.__name__ = name
     __fix_module_name(_NewFreeformRelation)
     return _NewFreeformRelation
+
+###
+### Tests
+###
+import unittest
+
+class TestIndexedRows(unittest.TestCase) :
+    class Likes(DirectedManyToManyRelation) :
+        pass
+
+    def test_remove_most_rows(self) :
+        data = self.Likes.setup_table()
+        for a, b in [("kyle", "ball"), ("kyle", "box"), ("kyle", "lamp"), ("bob", "ball")] :
+            self.Likes(a, b).add_relation(data)
+        self.Likes("kyle", X).remove_relation(data)
+        self.assertEqual(list(data), [("bob", "ball")])
+        self.assertEqual(self.Likes(X, "ball").query_relation(data), [{"x" : "bob"}])
+        for b in ["cup", "box", "lamp"] :
+            self.Likes("kyle", b).add_relation(data)
+        self.Likes(X, Y).remove_relation(data)
+        self.assertEqual(list(data), [])
+
+class TestReverseIndex(unittest.TestCase) :
+    class Holds(ManyToOneRelation) :
+        pass
+
+    def test_query_in_order_added(self) :
+        data = self.Holds.setup_table()
+        things = ["zebra", "apple", "mango", "kiwi", "banana", "cherry"]
+        for o in things :
+            self.Holds(o, "box").add_relation(data)
+        self.Holds("apple", Y).remove_relation(data)
+        self.Holds("apple", "box").add_relation(data)
+        self.assertEqual([m["x"] for m in self.Holds(X, "box").query_relation(data)],
+                         ["zebra", "mango", "kiwi", "banana", "cherry", "apple"])
+        copied = self.Holds.copy(data)
+        self.Holds("zebra", Y).remove_relation(copied)
+        self.assertEqual([m["x"] for m in self.Holds(X, "box").query_relation(copied)],
+                         ["mango", "kiwi", "banana", "cherry", "apple"])
+
+    def test_save_table(self) :
+        import pickle
+        data = self.Holds.setup_table()
+        for o, place in [("kiwi", "box"), ("box", "room"), ("apple", "box"), ("pear", "room")] :
+            self.Holds(o, place).add_relation(data)
+        self.assertEqual(self.Holds.path_to(data, "kiwi", "room"), ["kiwi", "box", "room"])
+        saved = pickle.dumps(self.Holds.save_table(data))
+        self.assertNotIn("PathCache", saved)
+        loaded = self.Holds.load_table(pickle.loads(saved))
+        self.assertEqual(list(loaded[0]), list(data[0]))
+        self.assertEqual([m["x"] for m in self.Holds(X, "box").query_relation(loaded)], ["kiwi", "apple"])
+        self.assertEqual(self.Holds.path_to(loaded, "apple", "room"), ["apple", "box", "room"])
+        self.assertRaises(Exception, self.Holds("pear", "box").add_relation, loaded)
+
+if __name__=="__main__" :
+    unittest.main(verbosity=2)
@@ -5,6 +5,7 @@
 import string
 import itertools
 import re
+from collections import OrderedDict
 
 def list_append(xs) :
     #return itertools.chain.from_iterable(xs)
@@ -68,6 +69,27 @@ def make_action_link(text, action) :
 def wrap_examine(eval, act, obj, text, ctxt) :
     return make_action_link(eval.eval_str(text, ctxt, actor=act), "examine "+eval.eval_str(ctxt.world.get_property("Name", obj), ctxt, actor=act))
 
+def _render_name(eval, act, obj, prop, cap, ctxt) :
+    text = eval.eval_str(ctxt.world.get_property(prop, obj), ctxt, actor=act)
+    if cap :
+        text = _cap(text)
+    return wrap_examine(eval, act, obj, text, ctxt)
+
+def render_name(eval, act, obj, prop, ctxt, cap=False) :
+    """Evaluates the property prop (such as DefiniteName) of the
+    object and wraps it in a link to examine the object.  If the
+    evaluator's names_cached is set, the result is cached in the world
+    (see World.cached) until something it read changes."""
+    if eval.names_cached :
+        key = ("render_name", prop, cap, obj, act, ctxt.actor)
+        try :
+            hash(key)
+        except TypeError :
+            pass
+        else :
+            return ctxt.world.cached(key, _render_name, eval, act, obj, prop, cap, ctxt)
+    return _render_name(eval, act, obj, prop, cap, ctxt)
+
 ###
 ### Object interface for fancy strings
 ###
@@ -121,21 +143,74 @@ class MalformedException(Exception) :
     pass
 
 
+TEMPLATE_CHARS = re.compile(r"[\[\]{}]")
+
+class TemplateCache(object) :
+    """An LRU cache from strings to their code for the
+    StringEvaluator (see compile_str), holding at most size of them.
+    Counts hits and misses so the hit rate can be checked."""
+    def __init__(self, size) :
+        self.size = size
+        self.templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    def get(self, input) :
+        """Returns the code for the input, raising KeyError if there
+        isn't any."""
+        try :
+            code = self.templates.pop(input)
+        except KeyError :
+            self.misses += 1
+            raise
+        self.templates[input] = code # now the most recently used
+        self.hits += 1
+        return code
+    def __contains__(self, input) :
+        return input in self.templates
+    def put(self, input, code) :
+        self.templates[input] = code
+        while len(self.templates) > self.size :
+            self.templates.popitem(last=False)
+    def hit_rate(self) :
+        total = self.hits + self.misses
+        return float(self.hits)/total if total else 0.0
+    def clear(self) :
+        self.templates.clear()
+        self.hits = 0
+        self.misses = 0
+
 class StringEvaluator(object) :
     """The StringEvaulator object represents a string transformer
     which parses a string using a simple programming language.  More
     of a description is in the eval_str method.
 
-    It's basically a scheme interpreter."""
+    It's basically a scheme interpreter.  Parsed strings are kept in
+    a TemplateCache, which copies share since the code for a string
+    does not depend on the eval functions."""
+
+    TEMPLATE_CACHE_SIZE = 2000
 
-    def __init__(self) :
+    def __init__(self, templates=None) :
         self.eval_functions = dict()
+        if templates is None :
+            templates = TemplateCache(self.TEMPLATE_CACHE_SIZE)
+        self.templates = templates
+        self.names_cached = True # see render_name
+        self.reset_counters()
 
     def copy(self) :
-        newse = StringEvaluator()
+        newse = StringEvaluator(self.templates)
         newse.eval_functions = self.eval_functions.copy()
+        newse.names_cached = self.names_cached
         return newse
 
+    def reset_counters(self) :
+        """Resets the number of calls to eval_str and the deepest
+        nesting of them (say, at the start of a turn)."""
+        self.calls = 0
+        self.depth = 0
+        self.max_depth = 0
+
     def add_eval_func(self, name) :
         def _add_eval_func(f) :
             if name in self.eval_functions :
@@ -162,33 +237,75 @@ class StringEvaluator(object) :
         """
         if not actor :
             actor = context.actor
-        # first we need to parse the string
-        parsed, i = self.__eval_parse(input)
-        code = ["append"]
+        self.calls += 1
+        self.depth += 1
+        if self.depth > self.max_depth :
+            self.max_depth = self.depth
+        try :
+            evaled = self.__eval(self.compile_str(input), context, actor)
+            return "".join([str(o) for o in evaled])
+        finally :
+            self.depth -= 1
+
+    def compile_str(self, input) :
+        """Parses the string into the code which eval_str evaluates.
+        The code is kept in the template cache, and it must not be
+        modified."""
         try :
-            i = 0
-            while i < len(parsed) :
-                i, val = self.__collect_structures(parsed, i)
-                code.append(val)
+            return self.templates.get(input)
+        except KeyError :
+            pass
+        try :
+            code = self.__compile(input)
         except MalformedException as x :
             print "eval_str: Offending input is"
             print input
             raise x
-        evaled = self.__eval(code, context, actor)
-        return "".join([str(o) for o in evaled])
+        self.templates.put(input, code)
+        return code
+
+    def precompile(self, items) :
+        """Takes (key, string) pairs and compiles the strings which
+        have brackets or braces into the template cache ahead of time.  The
+        strings are checked more strictly than eval_str does (for
+        instance, for an unmatched '[').  Returns the list of (key,
+        string, exception) for the strings which are malformed."""
+        malformed = []
+        for key, input in items :
+            if TEMPLATE_CHARS.search(input) and input not in self.templates :
+                try :
+                    self.templates.put(input, self.__compile(input, strict=True))
+                except MalformedException as x :
+                    malformed.append((key, input, x))
+        return malformed
+
+    def __compile(self, input, strict=False) :
+        try :
+            parsed, i = self.__eval_parse(input, strict=strict)
+        except IndexError :
+            raise MalformedException("Unmatched '{' or '<'.")
+        if strict and i < len(input) :
+            raise MalformedException("Unmatched ']'.")
+        code = ["append"]
+        i = 0
+        while i < len(parsed) :
+            i, val = self.__collect_structures(parsed, i)
+            code.append(val)
+        return code
 
-    def __eval_parse(self, input, i=0, in_code=False) :
+    def __eval_parse(self, input, i=0, in_code=False, strict=False) :
         """Pulls out [] and {} expressions, labeling them as such.
         Also makes it so [] expressions split by whitespace.  The
         characters < and > delimit strings when in_code.  Note that
-        all whitespace is collapsed into a single space for < and >."""
+        all whitespace is collapsed into a single space for < and >.
+        If strict, then an unmatched [ or } is a MalformedException."""
         parsed = []
         j = i
         while i < len(input) :
             if input[i] == "[" :
                 if i > j :
                     parsed.append(input[j:i])
-                parsed2, i2 = self.__eval_parse(input, i+1, in_code=True)
+                parsed2, i2 = self.__eval_parse(input, i+1, in_code=True, strict=strict)
                 parsed.append(("code", parsed2))
                 i = i2
                 j = i
@@ -206,6 +323,8 @@ class StringEvaluator(object) :
                 i += 1
                 j = i
             elif input[i] == "}" :
+                if strict :
+                    raise MalformedException("Unmatched '}'.")
                 raise Exception("Unmatched '}' in "+input)
             elif input[i] == "<" and in_code :
                 if i > j :
@@ -222,6 +341,8 @@ class StringEvaluator(object) :
                 j = i
             else :
                 i += 1
+        if strict and in_code :
+            raise MalformedException("Unmatched '['.")
         if j < i :
             parsed.append(input[j:i])
         return (parsed, i)
@@ -372,25 +493,25 @@ def _str_eval_get(eval, act, ctxt, prop, *args) :
 def _str_eval_the(eval, act, ctxt, ob) :
     """Gets DefiniteName of the supplied object."""
     ob = ob[0]
-    return [wrap_examine(eval, act, ob, eval.eval_str(ctxt.world.get_property("DefiniteName", ob), ctxt, actor=act), ctxt)]
+    return [render_name(eval, act, ob, "DefiniteName", ctxt)]
 
 @stringeval.add_eval_func("a")
 def _str_eval_a(eval, act, ctxt, ob) :
     """Gets IndefiniteName of the supplied object."""
     ob = ob[0]
-    return [wrap_examine(eval, act, ob, eval.eval_str(ctxt.world.get_property("IndefiniteName", ob), ctxt, actor=act), ctxt)]
+    return [render_name(eval, act, ob, "IndefiniteName", ctxt)]
 
 @stringeval.add_eval_func("The")
 def _str_eval_The(eval, act, ctxt, ob) :
     """Gets DefiniteName of the supplied object, capitalized."""
     ob = ob[0]
-    return [wrap_examine(eval, act, ob, _cap(eval.eval_str(ctxt.world.get_property("DefiniteName", ob), ctxt, actor=act)), ctxt)]
+    return [render_name(eval, act, ob, "DefiniteName", ctxt, cap=True)]
 
 @stringeval.add_eval_func("A")
 def _str_eval_A(eval, act, ctxt, ob) :
     """Gets IndefiniteName of the supplied object, capitalized."""
     ob = ob[0]
-    return [wrap_examine(eval, act, ob, _cap(eval.eval_str(ctxt.world.get_property("IndefiniteName", ob), ctxt, actor=act)), ctxt)]
+    return [render_name(eval, act, ob, "IndefiniteName", ctxt, cap=True)]
 
 @stringeval.add_eval_func("cap")
 def _str_eval_cap(eval, act, ctxt, s) :
@@ -414,22 +535,22 @@ def _str_eval_eval_str(eval, act, ctxt, x) :
 def _str_eval_he(eval, act, ctxt, ob) :
     """Gets SubjectPronoun of the supplied object."""
     ob = ob[0]
-    return [wrap_examine(eval, act, ob, eval.eval_str(ctxt.world.get_property("SubjectPronoun", ob), ctxt, actor=act), ctxt)]
+    return [render_name(eval, act, ob, "SubjectPronoun", ctxt)]
 @stringeval.add_eval_func("him")
 def _str_eval_him(eval, act, ctxt, ob) :
     """Gets ObjectPronoun of the supplied object."""
     ob = ob[0]
-    return [wrap_examine(eval, act, ob, eval.eval_str(ctxt.world.get_property("ObjectPronoun", ob), ctxt, actor=act), ctxt)]
+    return [render_name(eval, act, ob, "ObjectPronoun", ctxt)]
 @stringeval.add_eval_func("He")
 def _str_eval_He(eval, act, ctxt, ob) :
     """Gets SubjectPronoun of the supplied object, capitalized."""
     ob = ob[0]
-    return [wrap_examine(eval, act, ob, _cap(eval.eval_str(ctxt.world.get_property("SubjectPronoun", ob), ctxt, actor=act)), ctxt)]
+    return [render_name(eval, act, ob, "SubjectPronoun", ctxt, cap=True)]
 @stringeval.add_eval_func("Him")
 def _str_eval_Him(eval, act, ctxt, ob) :
     """Gets ObjectPronoun of the supplied object, capitalized."""
     ob = ob[0]
-    return [wrap_examine(eval, act, ob, _cap(eval.eval_str(ctxt.world.get_property("ObjectPronoun", ob), ctxt, actor=act)), ctxt)]
+    return [render_name(eval, act, ob, "ObjectPronoun", ctxt, cap=True)]
 
 @stringeval.add_eval_func("newline")
 def _str_eval_newline(eval, act, ctxt) :
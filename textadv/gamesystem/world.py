@@ -7,13 +7,49 @@ from textadv.core.rulesystem import ActivityTable, PropertyTable, ActivityHelper
 
 class Property(BasicPattern) :
     """This is the main property class.  The numargs attribute must be
-    created."""
+    created.
+
+    If interning is turned on (see intern_properties), then making a
+    property with the same arguments twice gives back the same
+    instance, so its cached hash is reused and equality checks
+    succeed by identity.  The table is dropped whenever it holds
+    intern_limit properties, so it can't grow without bound."""
+    __slots__ = ()
+    _interned = None # dict (type, args) -> Property when interning is on
+    intern_limit = 10000
+    def __new__(cls, *args) :
+        table = Property._interned
+        if table is None :
+            return BasicPattern.__new__(cls)
+        key = (cls, args)
+        try :
+            return table[key]
+        except KeyError :
+            if len(table) >= Property.intern_limit :
+                table.clear()
+            self = table[key] = BasicPattern.__new__(cls)
+            return self
+        except TypeError : # unhashable arguments
+            return BasicPattern.__new__(cls)
     def __init__(self, *args) :
         if len(args) != self.numargs :
             raise Exception("Property requires exactly "+str(self.numargs)+" arguments.")
         self.args = args
 
+def intern_properties(enabled=True) :
+    """Turns the interning table for Property instances on or off.
+    It is off by default.  Turning it off drops the table."""
+    Property._interned = dict() if enabled else None
+
 class World(object) :
+    """The game world.  Once the game is defined, the results of
+    property lookups are cached across turns.  While a property is
+    being computed, the world records which keys of
+    modified_properties and which relation tables were read (including
+    whatever was read by the properties it looked up), and the result
+    is thrown away as soon as one of those changes.  Set
+    property_cache_enabled to False to debug handlers which depend on
+    anything other than the world."""
     def __init__(self) :
         self.properties = PropertyTable()
         self.property_types = dict() # name -> Property
@@ -23,30 +59,152 @@ class World(object) :
         self.relations = dict()
         self.relation_handlers = []
         self.name_to_relation = dict()
+        self.index_definitions = dict() # name -> (relations, build, update)
+        self.relation_indexes = dict() # relation -> list of index names
+        self.indexes = dict() # name -> built index
         self._activities = dict()
+        self.memoized_activities = set()
         self.activity = ActivityHelperObject(self)
+        self.memo = None # a dict while a memo scope is open
+        self.memo_depth = 0
+        self.property_cache_enabled = True
+        self.property_cache = dict() # item -> (value, dependencies)
+        self.property_dependents = dict() # dependency -> set of items
+        self.property_cache_hits = 0
+        self.property_cache_misses = 0
+        self.property_cache_invalidations = 0
+        self.dependency_frames = [] # dependency sets of the evaluations in progress
+        self.num_changes = 0
     def set_game_defined(self) :
         """Set when it's time to close off arbitrary property
         definitions."""
         self.game_defined = True
+        self.clear_property_cache()
+    def text_values(self) :
+        """Iterates over the (item, value) pairs of the properties
+        whose values are strings, both those in the property table
+        and those in modified_properties."""
+        for item, value, call in self.properties.entries() :
+            if not call and isinstance(value, basestring) :
+                yield item, value
+        for item, value in self.modified_properties.iteritems() :
+            if isinstance(value, basestring) :
+                yield item, value
     def __setitem__(self, item, value) :
         if self.game_defined :
+            self.__changed(item)
             self.modified_properties[item] = value
         else :
+            self.__changed(None)
             self.properties[item] = value
     def __getitem__(self, item) :
+        frames = self.dependency_frames
+        if frames :
+            frames[-1].add(item)
         if self.modified_properties.has_key(item) :
             return self.modified_properties[item]
-        return self.properties.get_property(item, {"world" : self})
+        if self.game_defined and self.property_cache_enabled :
+            return self.__cache_lookup(item, self.properties.get_property, item, {"world" : self})
+        memo = self.memo
+        if memo is None :
+            return self.properties.get_property(item, {"world" : self})
+        try :
+            return memo[item]
+        except KeyError :
+            value = memo[item] = self.properties.get_property(item, {"world" : self})
+            return value
     def handler(self, item) :
+        self.__changed(None)
+        self.clear_property_cache()
         return self.properties.handler(item)
 
+    def cached(self, key, f, *args) :
+        """Gives f(*args), which must only depend on the world and on
+        what is in key.  Once the game is defined, the result is
+        cached under key along with the property lookups, and is
+        thrown away when something it read from the world changes."""
+        if self.game_defined and self.property_cache_enabled :
+            return self.__cache_lookup(key, f, *args)
+        return f(*args)
+    def __cache_lookup(self, key, f, *args) :
+        frames = self.dependency_frames
+        try :
+            value, cached_deps = self.property_cache[key]
+        except KeyError :
+            pass
+        else :
+            self.property_cache_hits += 1
+            if frames :
+                frames[-1].update(cached_deps)
+            return value
+        self.property_cache_misses += 1
+        num_changes = self.num_changes
+        deps = set([key])
+        value = self.track_dependencies(deps, f, *args)
+        if self.num_changes == num_changes : # otherwise a handler changed the world
+            self.property_cache[key] = (value, deps)
+            dependents = self.property_dependents
+            for dep in deps :
+                try :
+                    dependents[dep].add(key)
+                except KeyError :
+                    dependents[dep] = set([key])
+        return value
+
+    def track_dependencies(self, deps, f, *args) :
+        """Calls f(*args), adding to the set deps whatever is read
+        from the world in the meantime.  These dependencies are also
+        passed on to the evaluation which is in progress, if any."""
+        frames = self.dependency_frames
+        frames.append(deps)
+        try :
+            return f(*args)
+        finally :
+            frames.pop()
+            if frames :
+                frames[-1].update(deps)
+    def clear_property_cache(self) :
+        self.property_cache = dict()
+        self.property_dependents = dict()
+    def property_cache_stats(self) :
+        return {"hits" : self.property_cache_hits,
+                "misses" : self.property_cache_misses,
+                "invalidations" : self.property_cache_invalidations,
+                "size" : len(self.property_cache)}
+
+    def begin_memo(self) :
+        """Opens a memo scope.  Until the matching end_memo, the
+        results of property lookups (and of activities defined with
+        memoize=True) are remembered.  The memo is dropped whenever
+        the world changes.  Scopes may be nested, and the memo is
+        kept until the outermost one ends."""
+        if self.memo_depth == 0 :
+            self.memo = dict()
+        self.memo_depth += 1
+    def end_memo(self) :
+        self.memo_depth -= 1
+        if self.memo_depth == 0 :
+            self.memo = None
+    def __changed(self, dependency) :
+        """Called when the world is about to change.  Drops the memo
+        (evaluations in progress store their results in the old memo,
+        which is then thrown away) along with the cached properties
+        which depend on the dependency (a key of modified_properties
+        or a relation type)."""
+        self.num_changes += 1
+        if self.memo is not None :
+            self.memo = dict()
+        items = self.property_dependents.pop(dependency, None)
+        if items :
+            cache = self.property_cache
+            for item in items :
+                if cache.pop(item, None) is not None :
+                    self.property_cache_invalidations += 1
+
     def _make_property(self, numargs, name) :
-        class _NewProperty(BasicPattern) :
-            def __init__(self, *args) :
-                if len(args) != numargs :
-                    raise Exception("Property requires exactly "+str(numargs)+" arguments.")
-                self.args = args
+        class _NewProperty(Property) :
+            pass
+        _NewProperty.numargs = numargs
         _NewProperty.__name__ = name
         return self.define_property(_NewProperty)
     def define_property(self, prop) :
@@ -63,9 +221,13 @@ class World(object) :
         return self[self.property_types[name](*args)]
 
     def add_relation(self, relation) :
+        self.__changed(type(relation))
         relation.add_relation(self.relations[type(relation)])
+        self.__update_indexes(relation, True)
     def remove_relation(self, relation) :
+        self.__changed(type(relation))
         relation.remove_relation(self.relations[type(relation)])
+        self.__update_indexes(relation, False)
     def define_relation(self, r) :
         if self.game_defined :
             raise Exception("Can't define new relation when game is defined.")
@@ -74,18 +236,54 @@ class World(object) :
         self.name_to_relation[r.__name__] = r
         return r
     def query_relation(self, relation, var=None) :
+        if self.dependency_frames :
+            self.dependency_frames[-1].add(type(relation))
         res = relation.query_relation(self.relations[type(relation)])
         if var is None :
             return res
         else :
             return [r[var.varName] for r in res]
     def r_path_to(self, r, a, b, **kwargs) :
+        if self.dependency_frames :
+            self.dependency_frames[-1].add(r)
         return r.path_to(self.relations[r], a, b, **kwargs)
     def get_relation(self, name) :
         return self.name_to_relation[name]
 
-    def define_activity(self, name, **kwargs) :
+    def define_index(self, name, relations, build, update=None) :
+        """Defines an index derived from the given relations.
+        build(world) makes the index, and it is made the first time
+        get_index is called.  When one of the relations changes,
+        update(index, relation, added, world) is called after the
+        change, and the index is thrown away to be rebuilt if there is
+        no update function or it returns False."""
+        self.index_definitions[name] = (tuple(relations), build, update)
+        for r in relations :
+            self.relation_indexes.setdefault(r, []).append(name)
+        self.indexes.pop(name, None)
+    def get_index(self, name) :
+        relations, build, update = self.index_definitions[name]
+        if self.dependency_frames :
+            self.dependency_frames[-1].update(relations)
+        try :
+            return self.indexes[name]
+        except KeyError :
+            index = self.indexes[name] = build(self)
+            return index
+    def __update_indexes(self, relation, added) :
+        for name in self.relation_indexes.get(type(relation), ()) :
+            if name in self.indexes :
+                update = self.index_definitions[name][2]
+                if update is None or update(self.indexes[name], relation, added, self) is False :
+                    del self.indexes[name]
+
+    def define_activity(self, name, memoize=False, **kwargs) :
+        """Defines an activity.  If memoize is set, then the activity
+        is assumed to only query the world, and its results are
+        remembered in a memo scope (see begin_memo)."""
         self._activities[name] = ActivityTable(**kwargs)
+        if memoize :
+            self.memoized_activities.add(name)
     def to(self, name, **kwargs) :
         if self.game_defined :
             raise Exception("Can't add new actions when game is defined.")
@@ -96,7 +294,22 @@ class World(object) :
             return f
         return _to
     def call_activity(self, name, *args) :
-        return self._activities[name].notify(args, {"world" : self})
+        memo = self.memo
+        if memo is None or name not in self.memoized_activities :
+            return self._activities[name].notify(args, {"world" : self})
+        key = (name,) + args
+        try :
+            value, deps = memo[key]
+        except KeyError :
+            deps = set()
+            value = self.track_dependencies(deps, self._activities[name].notify, args, {"world" : self})
+            memo[key] = (value, deps)
+        except TypeError : # unhashable arguments
+            return self._activities[name].notify(args, {"world" : self})
+        else :
+            if self.dependency_frames :
+                self.dependency_frames[-1].update(deps)
+        return value
     def activity_table(self, name) :
         """Gets the action table of the given name."""
         return self._activities[name]
@@ -112,28 +325,39 @@ class World(object) :
         for k,v in self.modified_properties.iteritems() :
             newworld.modified_properties[k] = v
         newworld.game_defined = self.game_defined
+        newworld.property_cache_enabled = self.property_cache_enabled
         for r,data in self.relations.iteritems() :
             newworld.relations[r] = r.copy(data)
         newworld.relation_handlers = list(self.relation_handlers)
         newworld.name_to_relation = self.name_to_relation.copy()
+        newworld.index_definitions = self.index_definitions.copy()
+        newworld.relation_indexes = dict((r, list(names)) for r, names in self.relation_indexes.iteritems())
         for name, table in self._activities.iteritems() :
             newworld._activities[name] = table.copy()
+        newworld.memoized_activities = set(self.memoized_activities)
         return newworld
     def serialize(self) :
         import pickle
         mp = []
         for k,v in self.modified_properties.iteritems() :
             mp.append((self.inv_property_types[type(k)], k.args, v))
-        return pickle.dumps((mp, self.relations))
+        rels = dict((r, r.save_table(data)) for r, data in self.relations.iteritems())
+        return pickle.dumps((mp, rels))
     def deserialize(self, data) :
         import pickle
         import copy
         mp, rel = pickle.loads(data)
         newworld = copy.copy(self)
+        newworld.activity = ActivityHelperObject(newworld)
+        newworld.memo = None
+        newworld.memo_depth = 0
+        newworld.dependency_frames = []
+        newworld.clear_property_cache()
+        newworld.indexes = dict()
         newworld.modified_properties = dict()
         for name, args, v in mp :
             newworld.modified_properties[self.property_types[name](*args)] = v
-        newworld.relations = rel
+        newworld.relations = dict((r, r.load_table(saved)) for r, saved in rel.iteritems())
         return newworld
 
     def dump(self) :
@@ -165,3 +389,36 @@ class World(object) :
         for name, table in self._activities.iteritems() :
             print "<h"+sshls+">to "+escape(name)+"</h"+sshls+">"
             table.make_documentation(escape, heading_level=heading_level+3)
+
+###
+### Tests
+###
+import unittest
+
+class TestWorld(unittest.TestCase) :
+    def tearDown(self) :
+        intern_properties(False)
+
+    def test_intern_properties(self) :
+        from textadv.basicsetup import Location
+        world = World()
+        Weight = world._make_property(1, "Weight")
+        self.assertIsNot(Location("player"), Location("player"))
+        intern_properties()
+        self.assertIs(Location("player"), Location("player"))
+        self.assertIs(Weight("ball"), Weight("ball"))
+        self.assertIsNot(Location("player"), Location("ball"))
+        self.assertIsNot(Location([1]), Location([1])) # unhashable
+        self.assertRaises(Exception, Weight, "ball", "box")
+        intern_properties(False)
+        self.assertIsNot(Location("player"), Location("player"))
+
+    def test_intern_limit(self) :
+        from textadv.basicsetup import Location
+        intern_properties()
+        for i in xrange(Property.intern_limit + 1) :
+            Location(i)
+        self.assertTrue(len(Property._interned) <= Property.intern_limit)
+
+if __name__=="__main__" :
+    unittest.main(verbosity=2)
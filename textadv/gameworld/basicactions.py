@@ -243,10 +243,22 @@ class Taking(BasicAction) :
     numargs = 2
 parser.understand("take/get/pickup [something x]", Taking(actor, X))
 parser.understand("pick up [something x]", Taking(actor, X))
+parser.understand("take/get/pickup [somethings x]", Taking(actor, X))
+parser.understand("pick up [somethings x]", Taking(actor, X))
 
 require_xobj_accessible(actionsystem, Taking(actor, X))
 hint_xobj_notheld(actionsystem, Taking(actor, X))
 
+@allincludes(Taking(actor, X))
+def allincludes_taking_default(actor, x, ctxt) :
+    """Taking all leaves out the actor, people, what the actor already
+    has (even inside something else it has), and what is fixed in
+    place or part of something."""
+    if (actor == x or ctxt.world[IsA(x, "person")] or x in ctxt.world[Contents(actor)]
+        or ctxt.world[Owner(x)] == actor
+        or ctxt.world[FixedInPlace(x)] or ctxt.world.query_relation(PartOf(x, Y))) :
+        return False
+
 @before(Taking(actor, X))
 def before_take_when_already_have(actor, x, ctxt) :
     """You can't take what you already have.  Uses the contents of the
@@ -322,9 +334,16 @@ class Dropping(BasicAction) :
     gerund = "dropping"
     numargs = 2
 parser.understand("drop [something x]", Dropping(actor, X))
+parser.understand("drop [somethings x]", Dropping(actor, X))
 
 require_xobj_held(actionsystem, Dropping(actor, X), only_hint=True, transitive=True)
 
+@allincludes(Dropping(actor, X))
+def allincludes_dropping_default(actor, x, ctxt) :
+    """Dropping all only includes what the actor has."""
+    if not ctxt.world.query_relation(Has(actor, x)) :
+        return False
+
 @before(Dropping(actor, X) <= PEquals(actor, X))
 def before_dropping_self(actor, x, ctxt) :
     """One can't drop oneself."""
@@ -940,10 +959,18 @@ class InsertingInto(BasicAction) :
     gerund = ("inserting", "into")
     numargs = 3
 parser.understand("put/insert/drop [something x] in/into [something y]", InsertingInto(actor, X, Y))
+parser.understand("put/insert/drop [somethings x] in/into [something y]", InsertingInto(actor, X, Y))
 
 require_xobj_held(actionsystem, InsertingInto(actor, X, Y))
 require_xobj_accessible(actionsystem, InsertingInto(actor, Z, X))
 
+@allincludes(InsertingInto(actor, X, Y))
+def allincludes_InsertingInto_default(actor, x, y, ctxt) :
+    """Inserting all only includes what the actor has, other than the
+    container."""
+    if x == y or not ctxt.world.query_relation(Has(actor, x)) :
+        return False
+
 @before(InsertingInto(actor, X, Y) <= PEquals(X, Y))
 def before_InsertingInto_not_on_itself(actor, x, y, ctxt) :
     """One can't place something in itself."""
@@ -998,10 +1025,18 @@ class PlacingOn(BasicAction) :
     gerund = ("placing", "on")
     numargs = 3
 parser.understand("put/place/drop [something x] on/onto [something y]", PlacingOn(actor, X, Y))
+parser.understand("put/place/drop [somethings x] on/onto [something y]", PlacingOn(actor, X, Y))
 
 require_xobj_held(actionsystem, PlacingOn(actor, X, Y))
 require_xobj_accessible(actionsystem, PlacingOn(actor, Z, X))
 
+@allincludes(PlacingOn(actor, X, Y))
+def allincludes_PlacingOn_default(actor, x, y, ctxt) :
+    """Placing all only includes what the actor has, other than the
+    supporter."""
+    if x == y or not ctxt.world.query_relation(Has(actor, x)) :
+        return False
+
 @before(PlacingOn(actor, X, Y) <= PEquals(X, Y))
 def before_PlacingOn_not_on_itself(actor, x, y, ctxt) :
     """One can't place something on itself."""
@@ -34,7 +34,7 @@ def default_move_backdrops(curr_loc, world) :
 ## Activity: get the doors in a room
 ##
 
-world.define_activity("get_room_doors", accumulator=list_append,
+world.define_activity("get_room_doors", accumulator=list_append, memoize=True,
                       doc="""Gets a list of doors that are in a particular room.""")
 @world.to("get_room_doors")
 def default_get_room_doors(room, world) :
@@ -48,7 +48,7 @@ def default_get_room_doors(room, world) :
 ## Activity: get the other side of a door
 ##
 
-world.define_activity("door_other_side_from", accumulator=lambda x : x[0],
+world.define_activity("door_other_side_from", accumulator=lambda x : x[0], memoize=True,
                       doc="""Gets the room on the other side of a door from a given room.""")
 @world.to("door_other_side_from")
 def default_door_other_side_from(door, room, world) :
@@ -66,7 +66,7 @@ def default_door_other_side_from(door, room, world) :
 ## Activities: getting exits from a room
 ##
 
-world.define_activity("get_room_exit_directions", accumulator=list_append,
+world.define_activity("get_room_exit_directions", accumulator=list_append, memoize=True,
                       doc="""Gets the directions from a room one can leave.""")
 
 @world.to("get_room_exit_directions")
@@ -74,6 +74,44 @@ def default_get_room_exit_directions(room, world) :
     """Just looks through the Exit relation table."""
     return world.query_relation(Exit(room, X, Y), var=X)
 
+##
+## Activity: getting the objects in scope
+##
+
+world.define_activity("objects_in_scope", accumulator=list_append, memoize=True,
+                      doc="""Gets the objects an actor might be referring
+                      to, which the parser tries before anything else.""")
+
+@world.to("objects_in_scope")
+def default_objects_in_scope(actor, world) :
+    """Everything in, on, had by, worn by, or part of the visible
+    container of the actor, transitively, along with the doors of the
+    visible container.  Some of these may not actually be visible
+    (for instance, if it is dark), but the verifier decides that."""
+    vis_cont = world[VisibleContainer(world[Location(actor)])]
+    scope = [vis_cont]
+    seen = set(scope)
+    for o in scope :
+        children = (world.query_relation(Contains(o, Y), var=Y)
+                    + world.query_relation(Supports(o, Y), var=Y)
+                    + world.query_relation(Has(o, Y), var=Y)
+                    + world.query_relation(Wears(o, Y), var=Y)
+                    + world.query_relation(PartOf(Y, o), var=Y))
+        for c in children :
+            if c not in seen :
+                seen.add(c)
+                scope.append(c)
+    return scope + world.activity.get_room_doors(vis_cont)
+
+@parser.object_scope.add_handler
+def parser_object_scope_something(parser, subparser, kind, ctxt) :
+    """The something subparser first tries the objects in the scope
+    of the actor.  The scope is cached until the world changes in a
+    way which affects it."""
+    if subparser != "something" :
+        raise NotHandled()
+    return ctxt.world.cached(("objects_in_scope", ctxt.actor), ctxt.world.activity.objects_in_scope, ctxt.actor)
+
 
 ###
 ### Actor Activities
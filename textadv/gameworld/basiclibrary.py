@@ -2,6 +2,7 @@
 #
 # This is the basic library for how the world works.
 
+from collections import OrderedDict
 from textadv.core.patterns import VarPattern, BasicPattern, PNot, PEquals
 from textadv.core.rulesystem import handler_requires, ActionHandled, MultipleResults, NotHandled, AbortAction, make_rule_decorator
 from textadv.gamesystem.relations import *
@@ -11,7 +12,7 @@ from textadv.gamesystem.basicpatterns import *
 from textadv.gamesystem.utilities import *
 #import textadv.gamesystem.parser as parser
 from textadv.gamesystem.parser import default_parser
-from textadv.gamesystem.actionsystem import BasicAction, DoInstead, verify_instead, ActionSystem
+from textadv.gamesystem.actionsystem import BasicAction, DoInstead, verify_instead, ActionSystem, MultipleObjects
 from textadv.gamesystem.actionsystem import VeryLogicalOperation, LogicalOperation, IllogicalOperation, IllogicalInaccessible, NonObviousOperation, IllogicalNotVisible
 
 ###
@@ -26,6 +27,7 @@ trybefore = make_rule_decorator(actionsystem.action_trybefore)
 before = make_rule_decorator(actionsystem.action_before)
 when = make_rule_decorator(actionsystem.action_when)
 report = make_rule_decorator(actionsystem.action_report)
+allincludes = make_rule_decorator(actionsystem.action_allincludes)
 
 parser = default_parser.copy()
 
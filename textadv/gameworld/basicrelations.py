@@ -175,40 +175,79 @@ class IsA(ManyToOneRelation, Property) :
     relation."""
     numargs=2
 
+# The "kinds" index keeps the transitive closure of KindOf along with
+# which objects are of which kinds.  It is a tuple (ancestors,
+# kind_of, instances), where ancestors maps each kind to the set of
+# kinds it is a kind of (including itself), kind_of maps each object
+# to its direct kind, and instances maps each kind to an OrderedDict
+# whose keys are all of the objects of that kind.
+
+def build_kind_index(world) :
+    parents = dict((m["x"], m["y"]) for m in world.query_relation(KindOf(X, Y)))
+    ancestors = dict()
+    for kind in parents :
+        ancestors[kind] = set([kind])
+        k = kind
+        while k in parents and parents[k] not in ancestors[kind] :
+            k = parents[k]
+            ancestors[kind].add(k)
+    index = (ancestors, dict(), dict())
+    for m in world.query_relation(IsA(X, Y)) :
+        update_kind_index(index, IsA(m["x"], m["y"]), True, world)
+    return index
+
+def update_kind_index(index, relation, added, world) :
+    if type(relation) is not IsA :
+        return False # the kinds themselves changed, so rebuild
+    ancestors, kind_of, instances = index
+    o = relation.args[0]
+    if added :
+        kind = kind_of[o] = relation.args[1]
+        for k in ancestors.get(kind, (kind,)) :
+            instances.setdefault(k, OrderedDict())[o] = None
+    elif o in kind_of :
+        kind = kind_of.pop(o)
+        for k in ancestors.get(kind, (kind,)) :
+            del instances[k][o]
+
+world.define_index("kinds", [KindOf, IsA], build_kind_index, update_kind_index)
+
 @world.handler(IsA(X,Y))
 def property_handler_IsA(x, y, world) :
     """Lets one ask whether a particular object is of a particular
-    kind, searching up the KindOf tree."""
-    kind = world.query_relation(IsA(x, Z), var=Z)
-    if not kind :
+    kind.  The kind index answers whether it is, and as before the
+    value is then the path up the KindOf tree from the object's kind
+    to the kind (False if the object has no kind, and None if it
+    isn't of that kind)."""
+    ancestors, kind_of, instances = world.get_index("kinds")
+    kind = kind_of.get(x)
+    if kind is None :
         return False
+    elif x not in instances.get(y, ()) :
+        return None
     else :
-        return world.r_path_to(KindOf, kind[0], y)
+        return world.r_path_to(KindOf, kind, y)
 
 world.define_activity("referenceable_things", accumulator=list_append)
 @world.to("referenceable_things")
 def referenceable_things_Default(world) :
     """Gets all things in the world (that is, all objects which
     inherit from "thing")."""
-    objects = world.query_relation(IsA(X, Y), var=X)
-    things = [o for o in objects if world[IsA(o, "thing")]]
-    return things
+    return world.activity.objects_of_kind("thing")
 
 world.define_activity("referenceable_rooms", accumulator=list_append)
 @world.to("referenceable_rooms")
 def referenceable_things_Default(world) :
     """Gets all things in the world (that is, all objects which
     inherit from "thing")."""
-    objects = world.query_relation(IsA(X, Y), var=X)
-    rooms = [o for o in objects if world[IsA(o, "room")]]
-    return rooms
+    return world.activity.objects_of_kind("room")
 
-world.define_activity("objects_of_kind", accumulator=list_append)
+world.define_activity("objects_of_kind", accumulator=list_append, memoize=True)
 @world.to("objects_of_kind")
 def objects_of_type_Default(kind, world) :
     """Gets all objects of a given kind."""
-    objects = world.query_relation(IsA(X, Y), var=X)
-    return [o for o in objects if world[IsA(o, kind)]]
+    ancestors, kind_of, instances = world.get_index("kinds")
+    return list(instances.get(kind, ()))
 
 ###
 ### Connecting rooms and doors together
@@ -218,14 +218,19 @@ application = tornado.web.Application(
     static_path=os.path.join(os.path.dirname(__file__), "static"))
 
 import threading
+from textadv.gamesystem.output import OutputBuilder, HTMLRenderer
 
 class TornadoGameIO(object) :
-    def __init__(self, outfile) :
+    """The game IO for a session of the web server.  Output is built
+    by an OutputBuilder with the given renderer (HTML by default), and
+    the output of each flush is kept until the client asks for it,
+    when the renderer combines them."""
+    def __init__(self, outfile, renderer=None) :
         self.main_lock = threading.BoundedSemaphore(1)
         self.input_lock = threading.Semaphore(0)
-        self.to_flush = []
+        self.output = OutputBuilder(renderer or HTMLRenderer())
         self.commands = []
-        self.to_output = ""
+        self.to_output = [] # the output of each flush not yet sent
         self.wants_output = None
         self.status_vars = {"prompt" : ">"}
         self.die = False
@@ -234,19 +239,19 @@ class TornadoGameIO(object) :
         self.main_lock.acquire()
         if self.to_output :
             if self.wants_output :
-                self.status_vars["text"] = self.to_output
+                self.status_vars["text"] = self.output.combine(self.to_output)
                 self.wants_output(self.status_vars)
                 self.status_vars = {"prompt" : self.status_vars["prompt"]}
                 self.wants_output = callback
-                self.to_output = ""
+                self.to_output = []
             else :
-                self.status_vars["text"] = self.to_output
+                self.status_vars["text"] = self.output.combine(self.to_output)
                 callback(self.status_vars)
                 self.status_vars = {"prompt" : self.status_vars["prompt"]}
-                self.to_output = ""
+                self.to_output = []
         else :
             if self.wants_output :
-                self.status_vars["text"] = ""
+                self.status_vars["text"] = self.output.combine([])
                 self.wants_output(self.status_vars)
                 self.status_vars = {"prompt" : self.status_vars["prompt"]}
             self.wants_output = callback
@@ -274,7 +279,8 @@ class TornadoGameIO(object) :
         self.main_lock.acquire()
         self.die = True
         if self.wants_output :
-            self.status_vars["text"] = "<i>Error: timeout</i>"
+            self.output.write("<i>Error: timeout</i>")
+            self.status_vars["text"] = self.output.finish()
             self.wants_output(self.status_vars)
             self.status_vars = {"prompt" : self.status_vars["prompt"]}
             self.wants_output = None
@@ -292,22 +298,20 @@ class TornadoGameIO(object) :
         self.input_lock.release()
     def write(self, *data) :
         self.main_lock.acquire()
-        self.to_flush.extend(data)
+        self.output.write(*data)
         self.main_lock.release()
     def flush(self) :
         self.main_lock.acquire()
-        out = " ".join(self.to_flush).replace("[newline]", "</p><p>").replace("[break]", "<br>")
-        out = out.replace("[indent]", "&nbsp;&nbsp;")
-        self.to_output += "<p>"+out+"</p>"
-        self.to_flush = []
+        out = self.output.finish()
+        self.to_output.append(out)
         if self.outfile :
-            self.outfile.write("\n\n<p>"+out+"</p>")
+            self.outfile.write("\n\n"+out)
             self.outfile.flush()
         if self.wants_output :
-            self.status_vars["text"] = self.to_output
+            self.status_vars["text"] = self.output.combine(self.to_output)
             self.wants_output(self.status_vars)
             self.status_vars = {"prompt" : self.status_vars["prompt"]}
-            self.to_output = ""
+            self.to_output = []
             self.wants_output = None
         self.main_lock.release()
 
@@ -347,6 +351,25 @@ sessions = {}
 sessions_timer = {}
 sessions_lock = threading.Semaphore(1)
 
+###
+### Tests
+###
+import unittest
+import json
+from textadv.gamesystem.output import JSONEventRenderer
+
+class TestTornadoGameIO(unittest.TestCase) :
+    def test_json_flushes_before_poll(self) :
+        io = TornadoGameIO(None, JSONEventRenderer())
+        io.write("Hello.")
+        io.flush()
+        io.write("[newline]Goodbye.")
+        io.flush()
+        polled = []
+        io.register_wants_output(polled.append)
+        self.assertEqual(json.loads(polled[0]["text"]),
+                         [{"text" : "Hello."}, {"code" : "newline"}, {"text" : "Goodbye."}])
+
 if __name__ == "__main__":
     port = 8888
     if len(sys.argv) > 1 :